@@ -2,6 +2,7 @@
 import sys
 import traceback
 import os
+import io
 import time
 from datetime import timedelta, datetime, date
 import subprocess
@@ -31,7 +32,10 @@ from PyQt5.QtWidgets import QSplashScreen, QMessageBox, QGraphicsScene, QFileDia
 
 # The libraries
 from lib import process_db
-from lib.process_img import Orthoframe
+from lib.process_img import OrthoframeCache, OrthoframePrefetcher
+from lib.columnar_db import ColumnarDb, is_columnar_db
+from lib.db_index import FileRowIndex, FileSetIndex
+from lib.sqlite_db import SqliteDb, is_sqlite_db
 from ui import deftui_ui, deftui_imgpreview_ui
 
 # Descartes
@@ -42,6 +46,17 @@ PUBLISHER = "CentreForIntelligentSystems"
 APP_TITLE = "Defect Type Database Preview and Preprocess"
 APP_VERSION = "0.2-alpha"
 
+# Memory budget of the decoded orthoframes kept for flipping back and forth
+ORTHOFRAME_CACHE_MB = 1024
+
+# Resolution of the whole frame in the left panel: 1 (full), 2, 4 or 8 times reduced.
+# The defect crops are always made from the full resolution raster
+ORTHOFRAME_OVERVIEW_SCALE = 4
+
+# Frames decoded in the background while looking at the current one (in the file list order)
+PREFETCH_NEXT_FRAMES = 3
+PREFETCH_PREV_FRAMES = 1
+
 # Some additional ones
 CONFIG_DIR_NAME = "configs"
 OUTPUT_DIR_NAME = "results"
@@ -65,7 +80,7 @@ class DeftImgPreviewUI(QtWidgets.QMainWindow, deftui_imgpreview_ui.Ui_frmImagePr
     # Figure contents to be plotted
     img_left = None
     img_right = None
-    img_right_boxes = None  # Will contain a list of cropped images with defect contents
+    img_right_boxes = None  # Will contain a list of (defect type, geometry) of the defects to crop
 
     # Current patch ID
     current_patch_id = None
@@ -158,7 +173,10 @@ class DeftImgPreviewUI(QtWidgets.QMainWindow, deftui_imgpreview_ui.Ui_frmImagePr
 
             # Store the patch ID for possible future use
             self.current_patch_id = patch_id
-            self.current_patch = self.img_right_boxes[self.current_patch_id][1]
+
+            # The crop is made only now, from the full resolution raster
+            geom = self.img_right_boxes[self.current_patch_id][1]
+            self.current_patch = self.orthoframe.bounds_crop_img(geom.bounds)
 
             # Show the patch
             self.show_patch()
@@ -348,7 +366,10 @@ class DeftImgPreviewUI(QtWidgets.QMainWindow, deftui_imgpreview_ui.Ui_frmImagePr
         try:
             self.setWindowTitle("Preview: " + db_entry["fn"])
 
-            self.orthoframe = Orthoframe(path_img + os.sep + db_entry["origin"], db_entry["fn"], db_entry["extent"])
+            # Decoded orthoframes are cached in the main window
+            cache = self.parent().orthoframe_cache
+            self.orthoframe = cache.get(path_img + os.sep + db_entry["origin"], db_entry["fn"], db_entry["extent"])
+            self.parent().log(cache.stats_line())
 
             self.clear_axes(self.axes_view_L)
             self.clear_axes(self.axes_view_R)
@@ -357,14 +378,15 @@ class DeftImgPreviewUI(QtWidgets.QMainWindow, deftui_imgpreview_ui.Ui_frmImagePr
             self.axes_view_R.set_yticks([])
             self.canvas_view_R.draw()
 
-            self.axes_view_L.imshow(self.orthoframe.img_content, extent=self.orthoframe.geo_extent)
+            # The overview is decoded at reduced resolution, the crops come from the full one
+            self.axes_view_L.imshow(self.orthoframe.overview, extent=self.orthoframe.geo_extent)
             self.toolbar_view_L.update()
 
             # Now let's have the shapes mate. Thanks to the descartes package we can draw them up pretty quickly.
             segments = {}
             ind = 0
             for defect in db_entry["defects"]:
-                segments[ind] = (defect[0], self.orthoframe.bounds_crop_img(defect[1].bounds), defect[1])
+                segments[ind] = (defect[0], defect[1])
                 patch = PolygonPatch(defect[1], ec='#ff0000', fc=self.label_color[defect[0]],
                                      alpha=0.4, zorder=1, picker=True)
                 patch.patch_id = ind
@@ -382,6 +404,111 @@ class DeftImgPreviewUI(QtWidgets.QMainWindow, deftui_imgpreview_ui.Ui_frmImagePr
         self.parent().handle_preview_close()
 
 
+# Raised in the loader thread when the load was cancelled
+class DbLoadCancelled(Exception):
+    pass
+
+
+# Loads the defect database in a worker thread, so the UI stays responsive meanwhile.
+# Progress is reported with the progress signal, the result with loaded or failed.
+# Cancel with requestInterruption(): the load stops at the next read or stage and emits nothing
+class DbLoaderThread(QtCore.QThread):
+
+    progress = QtCore.pyqtSignal(str)
+    loaded = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    # Report the progress of reading the pickle every this many percent
+    PROGRESS_STEP = 10
+
+    db_file = None
+
+    def __init__(self, db_file, parent=None):
+        super(DbLoaderThread, self).__init__(parent)
+        self.db_file = db_file
+
+    def check_cancelled(self):
+        if self.isInterruptionRequested():
+            raise DbLoadCancelled()
+
+    def run(self):
+        try:
+            result = self.load()
+        except DbLoadCancelled:
+            return
+        except Exception as err:
+            if not self.isInterruptionRequested():
+                self.failed.emit(str(err))
+            return
+        if not self.isInterruptionRequested():
+            self.loaded.emit(result)
+
+    def load(self):
+
+        if is_sqlite_db(self.db_file):
+            # The SQLite database is queried on demand, nothing is loaded in memory
+            db_store = SqliteDb(self.db_file)
+            return {"db_file": self.db_file, "defect_db": None, "db_store": db_store, "file_index": None,
+                    "file_sets": db_store, "stats": db_store.stats}
+
+        if is_columnar_db(self.db_file):
+            # Only the attribute columns are read here, geometries are read when first needed
+            db_store = ColumnarDb(self.db_file)
+            self.progress.emit("Reading the attribute columns...")
+            my_db = {"defect_db": db_store.attributes()}
+        else:
+            # Legacy pickled database
+            db_store = None
+            with open(self.db_file, "rb") as f:
+                my_db = pickle.load(io.BufferedReader(_ProgressReader(f, self), _ProgressReader.BUFFER_SIZE))
+        self.check_cancelled()
+
+        db = my_db["defect_db"]
+
+        self.progress.emit("Building the indexes...")
+        file_index = db_store.file_row_index() if db_store is not None else FileRowIndex.from_db(db)
+        self.check_cancelled()
+        file_sets = db_store.file_set_index() if db_store is not None else FileSetIndex.from_db(db)
+        self.check_cancelled()
+
+        # Statistics and filter vocabularies are stored with the database by the builder,
+        # they are only computed here for databases built before that
+        db_stats = db_store.stats if db_store is not None else my_db.get("stats")
+        if db_stats is None:
+            self.progress.emit("Computing the statistics...")
+            db_stats = process_db.compute_db_stats(db)
+
+        return {"db_file": self.db_file, "defect_db": db, "db_store": db_store, "file_index": file_index,
+                "file_sets": file_sets, "stats": db_stats}
+
+
+# Raw file reader for pickle.load that reports the progress of the loader and stops it when cancelled.
+# Wrap it in io.BufferedReader: the unpickler then reads from the buffer (with peek), and this
+# is only called once per buffer fill instead of once per pickle opcode
+class _ProgressReader(io.RawIOBase):
+
+    # Size of the reads from the file
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, f, loader):
+        self.f = f
+        self.loader = loader
+        self.size = max(os.fstat(f.fileno()).st_size, 1)
+        self.next_report = loader.PROGRESS_STEP
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        self.loader.check_cancelled()
+        n = self.f.readinto(b)
+        pct = 100 * self.f.tell() // self.size
+        if pct >= self.next_report:
+            self.loader.progress.emit("Reading the database: " + str(pct) + "%")
+            self.next_report = pct + self.loader.PROGRESS_STEP
+        return n
+
+
 # Main UI class with all methods
 class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
 
@@ -405,10 +532,18 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
 
     raw_db = None  # Perhaps to be redone in the future. The original DB format is redundant
     db = None  # This holds the dataframe
-    stats = None
+    db_store = None  # Columnar database the dataframe was read from or the SQLite database (None for the pickle)
+    file_index = None  # Filename -> rows of the dataframe
+    file_sets = None  # Origin/defect type -> files (for SQLite, the database itself)
+    db_loader = None  # Thread loading the database, if a load is in progress
+    db_loaders = None  # All the loader threads still running, also the cancelled ones
+    stats = None  # Defect counts by type
+    db_stats = None  # All precomputed statistics of the database (process_db.compute_db_stats)
     img_list = None
 
     img_preview_window = None
+    orthoframe_cache = None  # Decoded orthoframes (see ORTHOFRAME_CACHE_MB)
+    orthoframe_prefetcher = None  # Decodes the neighbouring frames into the cache
 
     # Configuration data
     config_data = None
@@ -421,6 +556,10 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
         super(DeftUI, self).__init__(parent)
         self.setupUi(self)
 
+        self.orthoframe_cache = OrthoframeCache(ORTHOFRAME_CACHE_MB * 1024 * 1024, ORTHOFRAME_OVERVIEW_SCALE)
+        self.orthoframe_prefetcher = OrthoframePrefetcher(self.orthoframe_cache)
+        self.db_loaders = set()
+
         # Config file storage: config file stored in user directory
         self.config_path = self.fix_path(os.path.expanduser("~")) + "." + PUBLISHER + os.sep
 
@@ -429,6 +568,17 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
         # Set up the status bar
         self.status_bar_message("ready")
 
+    # Stop a database load in progress before the window goes away
+    def closeEvent(self, event):
+        # A cancelled loader may still be in a stage that does not check for cancellation:
+        # all of them must finish before the window (their parent) is destroyed
+        for loader in list(self.db_loaders):
+            loader.requestInterruption()
+        for loader in list(self.db_loaders):
+            loader.wait()
+        self.orthoframe_prefetcher.shutdown()
+        event.accept()
+
     # Add preview window separately
     def add_preview_window(self):
         self.img_preview_window = DeftImgPreviewUI(self)
@@ -468,13 +618,9 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
     # Group defects for this file in a compact form
     def get_file_entry(self, fn):
 
-        if self.db is None:
+        if not self.db_loaded:
             print("Database is not loaded")
-
-        db_entry = {}
-        defects = []
-
-        entries = self.db[self.db["fn"] == fn]
+            return
 
         # Filter out the defect of interest
         filt_def = str(self.listFilterDefects.currentText())
@@ -482,21 +628,52 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
         # ... if the following option is enabled
         show_only_this = self.chkShowOnlyWithSelectedDefect.isChecked()
 
-        if entries.empty:
+        # The SQLite database is queried for this file only
+        if isinstance(self.db_store, SqliteDb):
+            db_entry = self.db_store.file_entry(fn, filt_def if filt_def != "All" and show_only_this else None)
+            if db_entry is None:
+                print("No entries for this file")
+            return db_entry
+
+        # Rows of this file from the filename index, no scan over the whole table
+        rows = self.file_index.rows(fn)
+        first_row = rows[0] if len(rows) else None
+
+        if len(rows) == 0:
             print("No entries for this file")
             return
 
-        for i, entry in entries.iterrows():
-            if filt_def == "All" or (filt_def == entry["type"] \
-                                     and show_only_this) or not show_only_this:
-                db_entry["fn"] = fn  # Redundant, need TODO
-                db_entry["origin"] = entry["origin"] # something about this
-                db_entry["extent"] = entry["extent"]
-                defects.append((entry["type"], entry["geometry"]))
+        types = np.asarray(self.db["type"].values[rows], dtype=object)
+        if filt_def != "All" and show_only_this:
+            rows = rows[types == filt_def]
+            types = types[types == filt_def]
+
+        # The columnar database keeps the geometries out of the dataframe,
+        # only the geometries of this file are materialized from the memory-mapped store
+        if self.db_store is not None:
+            geoms = self.db_store.geometries(rows)
+        else:
+            geoms = self.db["geometry"].values[rows]
 
-        db_entry["defects"] = defects
+        # All rows of the file share the origin and the extent
+        first = self.db.iloc[first_row]
+
+        db_entry = {"fn": fn,
+                    "origin": first["origin"],
+                    "extent": process_db.get_row_extent(first),
+                    "defects": list(zip(types, geoms))}
         return db_entry
 
+    # Origin and extent of the file, without materializing its defects
+    def get_file_frame(self, fn):
+        if isinstance(self.db_store, SqliteDb):
+            return self.db_store.file_frame(fn)
+        rows = self.file_index.rows(fn)
+        if len(rows) == 0:
+            return None
+        first = self.db.iloc[rows[0]]
+        return first["origin"], process_db.get_row_extent(first)
+
     # Set up those UI elements that depend on config
     def config_ui(self):
 
@@ -579,7 +756,10 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
             self.app.processEvents()
 
     def browse_defects_db(self):
-        fn = QtWidgets.QFileDialog.getOpenFileName(self, "Load database file", "", "Pickled database file (*.pkl)")
+        fn = QtWidgets.QFileDialog.getOpenFileName(self, "Load database file", "",
+                                                   "Defect database (*.coldb *.sqlite *.pkl);;"
+                                                   "Columnar database (*.coldb);;SQLite database (*.sqlite);;"
+                                                   "Pickled database file (*.pkl)")
 
         if fn[0] != "":
             self.txtDefectFileLoc.setText(self.fix_file_path(fn[0]))
@@ -595,51 +775,89 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
             self.config_save()
             self.update_image()
 
+    # Start loading the database in the background. A load in progress is cancelled,
+    # since it is for a file that is not selected anymore
     def update_db(self):
 
         db_file = self.config_data["MenuOptions"]["DefectDbFile"]
 
-        try:
-            self.log("Loading the defect database...")
-            with open(db_file, "rb") as f:
-                my_db = pickle.load(f)
-        except:
-            self.log("Cannot find the file " + db_file)
+        if self.db_loader is not None:
+            self.db_loader.requestInterruption()
+            self.log("Cancelled loading the previous database")
+
+        self.log("Loading the defect database...")
+        self.status_bar_message("processing")
+
+        loader = DbLoaderThread(db_file, self)
+        loader.progress.connect(lambda msg, l=loader: self.handle_db_progress(l, msg))
+        loader.loaded.connect(lambda res, l=loader: self.handle_db_loaded(l, res))
+        loader.failed.connect(lambda err, l=loader: self.handle_db_load_failed(l, err))
+        loader.finished.connect(lambda l=loader: self.db_loaders.discard(l))
+        loader.finished.connect(loader.deleteLater)
+        self.db_loader = loader
+        self.db_loaders.add(loader)
+        loader.start()
+
+    # Signals from a cancelled loader may still be queued, those are ignored
+    def handle_db_progress(self, loader, msg):
+        if loader is self.db_loader:
+            self.log(msg)
+
+    def handle_db_load_failed(self, loader, err):
+        if loader is not self.db_loader:
+            return
+        self.db_loader = None
+        self.log("Cannot load the database " + loader.db_file + ": " + err)
+        self.status_bar_message("ready")
+
+    # The database is loaded: take it into use (on the main thread)
+    def handle_db_loaded(self, loader, res):
+
+        if loader is not self.db_loader:
+            if isinstance(res["db_store"], SqliteDb):
+                res["db_store"].close()
             return
+        self.db_loader = None
+
+        # The SQLite connection of the previous database is not needed anymore
+        if isinstance(self.db_store, SqliteDb):
+            self.db_store.close()
 
         # Breaking change in this version (0.2): we do not process the
         # database anymore, but load it up directly (it comes preprocessed)
-        self.db = my_db["defect_db"]
-
-        # Statistics
-        unique_defects = self.db["type"].unique().tolist()
-        stats = {}
-        for deft in unique_defects:
-            stats[deft] = self.db[self.db["type"] == deft].shape[0]
+        self.db = res["defect_db"]
+        self.db_store = res["db_store"]
+        self.file_index = res["file_index"]
+        self.file_sets = res["file_sets"]
+        self.db_stats = res["stats"]
+        self.db_loaded = True
 
         # Store the statistics
-        self.stats = stats
+        self.stats = {deft: self.db_stats["type_counts"][deft] for deft in self.db_stats["types"]}
 
         # Populate the lists
         self.update_lists()
 
         self.log("Finished processing the database")
         self.print_stats()
+        self.status_bar_message("ready")
 
     def print_stats(self):
         self.log("Defect type statistics for this dataset:")
+        defect_counts = self.db_stats.get("type_defect_counts", {})
         for deft, amt in self.stats.items():
-            self.log(deft + ": " + str(amt))
+            if deft in defect_counts:
+                self.log(deft + ": " + str(amt) + " (" + str(defect_counts[deft]) + " distinct defects)")
+            else:
+                self.log(deft + ": " + str(amt))
 
     def update_lists(self):
 
-        if self.db is not None:
-
-            # Get all unique defects
-            unique_defects = self.db["type"].unique().tolist()
+        if self.db_loaded:
 
-            # Get all unique directories
-            unique_dirs = self.db["origin"].unique().tolist()
+            # Sorted vocabularies from the database statistics
+            unique_defects = self.db_stats["types"]
+            unique_dirs = self.db_stats["origins"]
 
             # Update all the lists
             self.listFilterDirs.clear()
@@ -667,10 +885,13 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
         # Remember current file name
         self.current_fn = str(self.listImages.currentText())
 
+        # The frames being prefetched are from the old file list
+        self.orthoframe_prefetcher.cancel()
+
         # Detach filename onchange event
         self.handle_file_onchange(False)
 
-        if self.db is None:
+        if not self.db_loaded:
             self.log("Cannot filter the files: no database loaded")
             return
 
@@ -685,11 +906,8 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
         if filt_def != "All":
             filter_cols["type"] = filt_def
 
-        filt_db = self.db[np.logical_and.reduce([(self.db[k] == v) for k, v in filter_cols.items()])] \
-            if filter_cols else self.db
-
-        # All unique filenames from filtered database
-        unique_files = filt_db["fn"].unique().tolist()
+        # All files matching the filters from the inverted index
+        unique_files = self.file_sets.files(filter_cols)
 
         self.listImages.clear()
         self.listImages.addItems(unique_files)
@@ -714,6 +932,23 @@ class DeftUI(QtWidgets.QMainWindow, deftui_ui.Ui_mainWinDefectInfo):
             db_entry = self.get_file_entry(fn)
             self.img_preview_window.load_image(root_path, db_entry)
 
+            # Meanwhile, decode the neighbours of this frame
+            self.prefetch_frames(root_path)
+
+    # Prefetch the frames following and preceding the current one in the file list
+    def prefetch_frames(self, root_path):
+        cur = self.listImages.currentIndex()
+        count = self.listImages.count()
+        idx = list(range(cur + 1, min(cur + 1 + PREFETCH_NEXT_FRAMES, count))) + \
+            list(range(max(cur - PREFETCH_PREV_FRAMES, 0), cur))
+
+        frames = []
+        for i in idx:
+            frame = self.get_file_frame(str(self.listImages.itemText(i)))
+            if frame is not None:
+                frames.append((root_path + os.sep + frame[0], str(self.listImages.itemText(i)), frame[1]))
+        self.orthoframe_prefetcher.prefetch(frames)
+
     # Create mask based on the defect info
     def create_mask_from_shapes(self):
 
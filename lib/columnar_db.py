@@ -0,0 +1,251 @@
+import os
+import io
+import json
+import pickle
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from lib.process_db import sort_defect_db, compute_db_stats, CATEGORICAL_COLS
+from lib.geometry_store import GeometryStore, write_geometry_store
+from lib.db_index import FileRowIndex, FileSetIndex
+
+# Columnar on-disk format of the defect database
+# The database is a directory with one file per column and a small JSON header:
+#   defect_db.coldb       header: row count, column kinds, vocabularies of the categoricals, CRS, metadata,
+#                         statistics (see process_db.compute_db_stats)
+#   <col>.npy             numeric columns and the codes of categorical columns
+#   <col>.pkl             any other (object) columns
+#   geometry.wkb          all geometries as WKB, one after another (see lib/geometry_store.py)
+#   geometry.offsets.npy  start offset of every geometry in geometry.wkb (plus the end)
+#   fn.offsets.npy        rows are sorted by filename, the row range of every filename
+#   <col>.files.npy       inverted index of origin and type: sorted file IDs of every value,
+#   <col>.files.offsets.npy   one after another, and the start of every value (plus the end)
+# Columns are read only when they are asked for, so the vocabularies of origins, types
+# and filenames are available without touching the geometries at all. The geometries
+# are memory-mapped and only materialized for the rows that are asked for
+
+COLDB_HEADER_NAME = "defect_db.coldb"
+COLDB_VERSION = 1
+FN_OFFSETS_NAME = "fn.offsets.npy"
+FILE_SET_COLS = ["origin", "type"]
+
+
+# The CRS as something JSON can store
+def _crs_to_json(crs):
+    if crs is None or isinstance(crs, (dict, str)):
+        return crs
+    return crs.to_string()
+
+
+# Smallest integer type for the categorical codes
+def _codes_dtype(n_categories):
+    for dt in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dt).max:
+            return dt
+    return np.int64
+
+
+# Write the defect database (GeoDataFrame) to out_dir in the columnar format.
+# meta is a dict of additional information, e.g. the image root directory.
+# stats are the precomputed statistics, computed here if not given
+def write_columnar_db(gdf, out_dir, meta=None, stats=None):
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Rows of the same file are kept together, so the row index is just an offsets table
+    gdf = sort_defect_db(gdf)
+
+    # The header is written last, an existing header means the database is complete
+    header_fn = os.path.join(out_dir, COLDB_HEADER_NAME)
+    if os.path.isfile(header_fn):
+        os.remove(header_fn)
+
+    columns = {}
+    for c in gdf.columns:
+        col = gdf[c]
+        if c == gdf.geometry.name:
+            write_geometry_store(col.values, out_dir)
+            columns[c] = {"kind": "wkb"}
+        elif c in CATEGORICAL_COLS or str(col.dtype) == "category":
+            col = col.astype("category")
+            cats = col.cat.categories.tolist()
+            np.save(os.path.join(out_dir, c + ".npy"), col.cat.codes.values.astype(_codes_dtype(len(cats))))
+            columns[c] = {"kind": "category", "categories": cats}
+        elif pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype):
+            np.save(os.path.join(out_dir, c + ".npy"), col.values)
+            columns[c] = {"kind": "numeric"}
+        else:
+            with open(os.path.join(out_dir, c + ".pkl"), "wb") as f:
+                pickle.dump(col.values, f)
+            columns[c] = {"kind": "object"}
+
+    fn_index = FileRowIndex.from_db(gdf)
+    np.save(os.path.join(out_dir, FN_OFFSETS_NAME), fn_index.offsets)
+
+    file_sets = FileSetIndex.from_db(gdf, FILE_SET_COLS)
+    for c in FILE_SET_COLS:
+        sets = [file_sets.sets[c][v] for v in columns[c]["categories"]]
+        np.save(os.path.join(out_dir, c + ".files.npy"),
+                np.concatenate(sets) if sets else np.zeros(0, dtype=np.int32))
+        np.save(os.path.join(out_dir, c + ".files.offsets.npy"),
+                np.concatenate([[0], np.cumsum([len(x) for x in sets])]).astype(np.int64))
+
+    header = {"version": COLDB_VERSION, "n_rows": len(gdf), "columns": columns,
+              "column_order": list(gdf.columns), "geometry_column": gdf.geometry.name,
+              "crs": _crs_to_json(gdf.crs), "meta": meta if meta is not None else {},
+              "fn_offsets": FN_OFFSETS_NAME, "file_sets": FILE_SET_COLS,
+              "stats": stats if stats is not None else compute_db_stats(gdf)}
+
+    with io.open(header_fn, "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+
+
+# Is the path a columnar database (its directory or the header file)?
+def is_columnar_db(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, COLDB_HEADER_NAME)
+    return os.path.basename(path) == COLDB_HEADER_NAME and os.path.isfile(path)
+
+
+# Reader of the columnar database. Columns are loaded lazily and cached
+class ColumnarDb:
+
+    db_dir = None
+    header = None
+    n_rows = 0
+    meta = None
+    crs = None
+
+    def __init__(self, path):
+
+        # Either the directory or the header file inside it
+        self.db_dir = path if os.path.isdir(path) else os.path.dirname(path)
+
+        with io.open(os.path.join(self.db_dir, COLDB_HEADER_NAME), "r", encoding="utf-8") as f:
+            self.header = json.load(f)
+
+        if self.header["version"] > COLDB_VERSION:
+            raise ValueError("Unsupported columnar database version " + str(self.header["version"]))
+
+        self.n_rows = self.header["n_rows"]
+        self.meta = self.header["meta"]
+        self.crs = self.header["crs"]
+        self._cache = {}
+        self._geometry_store = None
+
+    @property
+    def columns(self):
+        return list(self.header["column_order"])
+
+    @property
+    def geometry_column(self):
+        return self.header["geometry_column"]
+
+    # Sorted values of a categorical column, read from the header only
+    def vocabulary(self, col):
+        return list(self.header["columns"][col]["categories"])
+
+    # Codes of a categorical column (memory-mapped)
+    def codes(self, col):
+        return np.load(os.path.join(self.db_dir, col + ".npy"), mmap_mode="r")
+
+    def _read_column(self, col):
+        kind = self.header["columns"][col]["kind"]
+        if kind == "category":
+            return pd.Categorical.from_codes(np.asarray(self.codes(col)), self.vocabulary(col))
+        elif kind == "numeric":
+            return np.load(os.path.join(self.db_dir, col + ".npy"))
+        elif kind == "object":
+            with open(os.path.join(self.db_dir, col + ".pkl"), "rb") as f:
+                return pickle.load(f)
+        elif kind == "wkb":
+            return self.geometry_store().get_all()
+        raise ValueError("Unknown column kind: " + str(kind))
+
+    # Read a column (once, later calls are served from the cache)
+    def column(self, col):
+        if col not in self._cache:
+            self._cache[col] = self._read_column(col)
+        return self._cache[col]
+
+    # The memory-mapped geometry store
+    def geometry_store(self):
+        if self._geometry_store is None:
+            self._geometry_store = GeometryStore(self.db_dir)
+        return self._geometry_store
+
+    # Geometries of the given rows only, nothing is cached
+    def geometries(self, rows):
+        return self.geometry_store().get(rows)
+
+    # Precomputed statistics, None for databases written before they were stored
+    @property
+    def stats(self):
+        return self.header.get("stats")
+
+    # Filename -> rows index: the stored offsets table or, for databases written
+    # before the rows were sorted by filename, built from the codes
+    def file_row_index(self):
+        if "fn_offsets" in self.header:
+            offsets = np.load(os.path.join(self.db_dir, self.header["fn_offsets"]))
+            return FileRowIndex(self.vocabulary("fn"), offsets)
+        return FileRowIndex.from_codes(self.codes("fn"), self.vocabulary("fn"))
+
+    # Inverted index origin/type -> files: the stored one or, for databases
+    # written before it was stored, built from the codes
+    def file_set_index(self):
+        fns = self.vocabulary("fn")
+        if "file_sets" in self.header:
+            sets = {}
+            for c in self.header["file_sets"]:
+                files = np.load(os.path.join(self.db_dir, c + ".files.npy"), mmap_mode="r")
+                offsets = np.load(os.path.join(self.db_dir, c + ".files.offsets.npy"))
+                sets[c] = {v: files[offsets[i]:offsets[i + 1]] for i, v in enumerate(self.vocabulary(c))}
+            return FileSetIndex(fns, sets)
+        return FileSetIndex.from_codes(fns, self.codes("fn"),
+                                       {c: (self.codes(c), self.vocabulary(c)) for c in FILE_SET_COLS})
+
+    # Attribute columns as a DataFrame, no geometries are decoded
+    def attributes(self, columns=None):
+        if columns is None:
+            columns = [c for c in self.columns if c != self.geometry_column]
+        return pd.DataFrame({c: self.column(c) for c in columns}, columns=columns)
+
+    # Kind of a stored column: category, numeric, object or wkb
+    def column_kind(self, col):
+        return self.header["columns"][col]["kind"]
+
+    # The given rows as a GeoDataFrame, read without caching the columns. Categorical, numeric
+    # and geometry columns are read for the rows only, the categoricals keep only the categories
+    # of those rows; object columns are stored as whole pickles, so those are loaded in full
+    # (unless already cached, see column) and dropped afterwards
+    def read_rows(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        data = {}
+        for c in self.columns:
+            kind = self.column_kind(c)
+            if kind == "category":
+                data[c] = pd.Categorical.from_codes(np.asarray(self.codes(c)[rows]),
+                                                    self.vocabulary(c)).remove_unused_categories()
+            elif kind == "numeric":
+                data[c] = np.asarray(np.load(os.path.join(self.db_dir, c + ".npy"), mmap_mode="r")[rows])
+            elif kind == "wkb":
+                data[c] = self.geometries(rows)
+            else:
+                values = self._cache[c] if c in self._cache else self._read_column(c)
+                data[c] = values[rows]
+        return gpd.GeoDataFrame(data, columns=self.columns, geometry=self.geometry_column, crs=self.crs)
+
+    # The whole database as a GeoDataFrame
+    def to_geodataframe(self):
+        df = self.attributes()
+        return gpd.GeoDataFrame(df, geometry=self.column(self.geometry_column), crs=self.crs)
+
+
+# Legacy importer: convert a pickled database ({"defect_db": GeoDataFrame, ...}) to the columnar format
+def convert_pickle_db(pkl_file, out_dir):
+    with open(pkl_file, "rb") as f:
+        datas = pickle.load(f)
+    meta = {k: v for k, v in datas.items() if k not in ("defect_db", "stats")}
+    write_columnar_db(datas["defect_db"], out_dir, meta=meta, stats=datas.get("stats"))
@@ -0,0 +1,102 @@
+import numpy as np
+
+# Indexes over the defect database, so the viewer does not need to scan the whole table
+
+
+# Filename -> rows of the defect database.
+# The rows are ordered by filename (order is the permutation that sorts them, None if the
+# database is already sorted) and offsets[i]:offsets[i + 1] is the range of the i-th filename
+class FileRowIndex:
+
+    fns = None
+    offsets = None
+    order = None
+
+    def __init__(self, fns, offsets, order=None):
+        self.fns = list(fns)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.order = order
+        self._pos = {fn: i for i, fn in enumerate(self.fns)}
+
+    # Build the index from the codes of the categorical fn column
+    @classmethod
+    def from_codes(cls, codes, fns):
+        codes = np.asarray(codes)
+        counts = np.bincount(codes, minlength=len(fns))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        order = None
+        if len(codes) > 1 and np.any(codes[1:] < codes[:-1]):
+            order = np.argsort(codes, kind="mergesort")
+        return cls(fns, offsets, order)
+
+    # Build the index from a defect database in either schema
+    @classmethod
+    def from_db(cls, db):
+        fn = db["fn"].astype("category")
+        return cls.from_codes(fn.cat.codes.values, fn.cat.categories.tolist())
+
+    def __contains__(self, fn):
+        return fn in self._pos
+
+    # Positional rows of the file (empty if the file is not in the database)
+    def rows(self, fn):
+        i = self._pos.get(fn)
+        if i is None:
+            return np.zeros(0, dtype=np.int64)
+        if self.order is None:
+            return np.arange(self.offsets[i], self.offsets[i + 1])
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+    def count(self, fn):
+        i = self._pos.get(fn)
+        return 0 if i is None else int(self.offsets[i + 1] - self.offsets[i])
+
+
+# Inverted index: value of a categorical column (origin, type) -> sorted IDs of the files with
+# at least one such defect. The file IDs are the positions in the sorted filename vocabulary,
+# so a combination of filters is an intersection of sorted int arrays
+class FileSetIndex:
+
+    fns = None
+    sets = None
+
+    def __init__(self, fns, sets):
+        self.fns = list(fns)
+        self.sets = sets
+
+    # Build the index from the codes of fn and of the indexed columns
+    # (cols is a dict column -> (codes, categories))
+    @classmethod
+    def from_codes(cls, fns, fn_codes, cols):
+        n = len(fns)
+        fn_codes = np.asarray(fn_codes, dtype=np.int64)
+        sets = {}
+        for col, (codes, cats) in cols.items():
+            # Unique (value, file) pairs, sorted by value and then by file
+            pairs = np.unique(np.asarray(codes, dtype=np.int64) * n + fn_codes)
+            vals, files = pairs // n, (pairs % n).astype(np.int32)
+            bounds = np.searchsorted(vals, np.arange(len(cats) + 1))
+            sets[col] = {c: files[bounds[i]:bounds[i + 1]] for i, c in enumerate(cats)}
+        return cls(fns, sets)
+
+    # Build the index from a defect database in either schema
+    @classmethod
+    def from_db(cls, db, cols=("origin", "type")):
+        fn = db["fn"].astype("category")
+        cats = {}
+        for c in cols:
+            col = db[c].astype("category")
+            cats[c] = (col.cat.codes.values, col.cat.categories.tolist())
+        return cls.from_codes(fn.cat.categories.tolist(), fn.cat.codes.values, cats)
+
+    # Sorted IDs of the files matching all the filters (dict column -> value)
+    def file_ids(self, filters):
+        ids = None
+        for col, val in filters.items():
+            s = self.sets[col].get(val, np.zeros(0, dtype=np.int32))
+            ids = s if ids is None else np.intersect1d(ids, s, assume_unique=True)
+        return np.arange(len(self.fns)) if ids is None else ids
+
+    # Names of the files matching all the filters, in filename order
+    def files(self, filters):
+        return [self.fns[i] for i in self.file_ids(filters)]
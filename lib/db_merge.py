@@ -0,0 +1,171 @@
+import os
+import shutil
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+import geopandas as gpd
+
+from lib.process_db import join_gdf, compact_defect_db, printt, CATEGORICAL_COLS, DEFECT_ID_COL
+from lib.columnar_db import ColumnarDb, is_columnar_db
+from lib.db_partitions import PartitionedDbWriter, list_partitions, read_partition
+
+# Merge of several defect databases into one partitioned database (see lib/db_partitions.py).
+# The inputs may be pickled databases, partitioned databases or columnar databases.
+# The output is written one origin at a time, so only one origin of every input is in
+# memory at once (a pickle, or the object columns of a columnar database, are loaded in full,
+# but only one input at a time: it is first split into temporary partitions).
+# Identical rows are dropped using a hash of the row over the columns that all the inputs have.
+# Defect IDs (lib/defect_clusters.py) depend on the clustering of the whole input they come
+# from, so they are dropped: cluster the merged database again to get consistent IDs
+
+
+# Input: partitioned database
+class _PartitionedSource:
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+
+    def origins(self):
+        return list_partitions(self.db_dir)
+
+    def read(self, origin):
+        return read_partition(self.db_dir, origin)
+
+
+# Input: columnar database, only the rows of the origin are read
+class _ColumnarSource:
+
+    def __init__(self, path):
+        self.db = ColumnarDb(path)
+
+        # Rows of every origin, in row order
+        codes = np.asarray(self.db.codes("origin"))
+        order = np.argsort(codes, kind="mergesort")
+        bounds = np.searchsorted(codes[order], np.arange(len(self.origins()) + 1))
+        self.rows = {o: order[bounds[k]:bounds[k + 1]] for k, o in enumerate(self.origins())}
+
+    def origins(self):
+        return self.db.vocabulary("origin")
+
+    def read(self, origin):
+        return self.db.read_rows(self.rows[origin])
+
+    # Object columns are stored whole and cannot be read for the rows of one origin
+    def object_columns(self):
+        return [c for c in self.db.columns if self.db.column_kind(c) == "object"]
+
+    # Split into partitions in spill_dir, reading every object column only once
+    def spill(self, spill_dir):
+        for c in self.object_columns():
+            self.db.column(c)
+        writer = PartitionedDbWriter(spill_dir)
+        for origin in self.origins():
+            writer.write(origin, self.read(origin))
+        return _PartitionedSource(spill_dir)
+
+
+# Input: pickled database, split into partitions in spill_dir
+def _spill_pickle(pkl_file, spill_dir):
+    with open(pkl_file, "rb") as f:
+        gdf = pickle.load(f)["defect_db"]
+    writer = PartitionedDbWriter(spill_dir)
+    for origin, part in gdf.groupby(gdf["origin"].astype(str)):
+        writer.write(origin, part.reset_index(drop=True))
+    return _PartitionedSource(spill_dir)
+
+
+# Hash of every row over all the columns or the given ones (the geometry as WKB)
+def row_hashes(gdf, columns=None):
+    geom_col = gdf.geometry.name
+    cols = sorted([c for c in (gdf.columns if columns is None else columns) if c != geom_col])
+    values = [gdf[c].astype(object).values for c in cols]
+    hashes = []
+    for i, g in enumerate(gdf[geom_col].values):
+        h = hashlib.sha1()
+        for v in values:
+            h.update(str(v[i]).encode("utf-8"))
+            h.update(b"\x00")
+        h.update(g.wkb)
+        hashes.append(h.digest())
+    return hashes
+
+
+# Merge the databases in db_paths into the partitioned database out_dir.
+# Rows are kept in input order, duplicates after the first occurrence are dropped.
+# Returns the number of rows written and the number of duplicates dropped
+def merge_defect_dbs(db_paths, out_dir, progress=True):
+
+    writer = PartitionedDbWriter(out_dir)
+    spill_root = tempfile.mkdtemp(prefix="merge_", dir=out_dir)
+
+    try:
+        sources = []
+        for i, path in enumerate(db_paths):
+            if is_columnar_db(path):
+                src = _ColumnarSource(path)
+                if src.object_columns():
+                    if progress:
+                        printt("Splitting", path, "into partitions...")
+                    src = src.spill(os.path.join(spill_root, str(i)))
+                sources.append(src)
+            elif os.path.isdir(path):
+                sources.append(_PartitionedSource(path))
+            else:
+                if progress:
+                    printt("Splitting", path, "into partitions...")
+                sources.append(_spill_pickle(path, os.path.join(spill_root, str(i))))
+
+        src_origins = [set(src.origins()) for src in sources]
+        origins = sorted(set.union(set(), *src_origins))
+        crs = None
+        n_rows, n_dups = 0, 0
+
+        for k, origin in enumerate(origins):
+
+            parts = []
+            for src, src_o in zip(sources, src_origins):
+                if origin not in src_o:
+                    continue
+                part = src.read(origin)
+                if part.empty:
+                    continue
+
+                # All inputs must agree on the CRS, as in join_gdf
+                if crs is None:
+                    crs = part.crs
+                elif part.crs != crs:
+                    raise ValueError("Cannot merge defect databases with different CRS")
+
+                parts.append(compact_defect_db(part.drop(columns=DEFECT_ID_COL, errors="ignore")))
+
+            if not parts:
+                writer.write(origin, gpd.GeoDataFrame())
+                continue
+
+            # Inputs may have different attribute columns (missing ones are NaN after the join),
+            # so rows are compared on the columns all the inputs of this origin have
+            shared_cols = set.intersection(*[set(p.columns) for p in parts])
+            merged = join_gdf(parts)
+            dup = np.zeros(len(merged), dtype=bool)
+            seen = set()
+            for i, h in enumerate(row_hashes(merged, shared_cols)):
+                dup[i] = h in seen
+                seen.add(h)
+
+            merged = merged[~dup].reset_index(drop=True)
+            # Only the categories of this origin are kept
+            for c in CATEGORICAL_COLS:
+                merged[c] = merged[c].astype("category").cat.remove_unused_categories()
+            writer.write(origin, merged)
+            n_rows += int((~dup).sum())
+            n_dups += int(dup.sum())
+
+            if progress:
+                printt("Merged", origin, "(" + str(k + 1) + "/" + str(len(origins)) + "):",
+                       int((~dup).sum()), "rows,", int(dup.sum()), "duplicates")
+
+    finally:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
+    return n_rows, n_dups
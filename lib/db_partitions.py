@@ -0,0 +1,86 @@
+import os
+import pickle
+
+from lib.process_db import join_gdf, compact_defect_db, CATEGORICAL_COLS
+
+# Defect database stored as a dataset partitioned by origin: a directory with one
+# pickled GeoDataFrame per origin folder.
+# Partitions are written as soon as the origin is processed, so a crash only loses the
+# origins in progress. Every partition can carry the manifest of the inputs it was built
+# from (see test_scripts/defect_db_manifest.py), so a new run can reuse the partitions
+# whose inputs have not changed and rebuild the rest
+
+PARTITION_EXT = ".pkl"
+PARTITION_MANIFEST_EXT = ".manifest"
+
+
+# Write a pickle atomically: a partial file never appears under the final name
+def _dump_atomic(obj, fn):
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_fn, fn)
+
+
+class PartitionedDbWriter:
+
+    out_dir = None
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    def partition_file(self, origin):
+        return os.path.join(self.out_dir, origin + PARTITION_EXT)
+
+    # A partition exists only once it has been written completely
+    def is_complete(self, origin):
+        return os.path.isfile(self.partition_file(origin))
+
+    def manifest_file(self, origin):
+        return os.path.join(self.out_dir, origin + PARTITION_MANIFEST_EXT)
+
+    # The manifest is removed first and written last, so a partition is never left
+    # with the manifest of other inputs
+    def write(self, origin, gdf, manifest=None):
+        if os.path.isfile(self.manifest_file(origin)):
+            os.remove(self.manifest_file(origin))
+        _dump_atomic(gdf, self.partition_file(origin))
+        if manifest is not None:
+            _dump_atomic(manifest, self.manifest_file(origin))
+
+    # Manifest of the inputs of a complete partition, None if there is none
+    def read_manifest(self, origin):
+        if not self.is_complete(origin) or not os.path.isfile(self.manifest_file(origin)):
+            return None
+        with open(self.manifest_file(origin), "rb") as f:
+            return pickle.load(f)
+
+
+# Origins stored in the partitioned database
+def list_partitions(db_dir):
+    return sorted([fn[:-len(PARTITION_EXT)] for fn in os.listdir(db_dir) if fn.endswith(PARTITION_EXT)])
+
+
+def read_partition(db_dir, origin):
+    with open(os.path.join(db_dir, origin + PARTITION_EXT), "rb") as f:
+        return pickle.load(f)
+
+
+# Read the partitions (all or the given origins) into one GeoDataFrame.
+# With compact=True every partition is converted to the compact schema as soon as it is read,
+# so the full database is only ever in memory in the compact schema
+def read_partitioned_db(db_dir, origins=None, compact=False):
+    origins = list_partitions(db_dir) if origins is None else origins
+    gdf_list = []
+    for o in origins:
+        gdf = read_partition(db_dir, o)
+        gdf_list.append(compact_defect_db(gdf) if compact else gdf)
+    gdf = join_gdf([gdf for gdf in gdf_list if not gdf.empty] or gdf_list[:1])
+
+    # Partitions have different categories, the joined columns are categorical again
+    if compact:
+        for c in CATEGORICAL_COLS:
+            if c in gdf:
+                gdf[c] = gdf[c].astype("category")
+    return gdf
@@ -0,0 +1,79 @@
+import hashlib
+import numpy as np
+from rtree import index as rtree_index
+
+from lib.process_db import DEFECT_ID_COL
+
+# Clustering of duplicate defects across frames.
+# A defect polygon of the shapefile is intersected with every orthoframe it falls on, so one
+# physical defect becomes one row per overlapping frame. Rows of different frames are linked
+# when their geometries overlap by at least min_overlap (intersection area over the area of the
+# smaller one) and, by default, they have the same defect type. The linked rows form the clusters.
+# Candidate pairs come from a bulk-loaded R-tree self-join on the bounding boxes, so the
+# work grows with the number of rows times the (small) number of overlapping neighbours
+
+DEFAULT_MIN_OVERLAP = 0.5
+
+
+# Union-find with path halving
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+# Cluster label (0..n_clusters-1) of every row
+def cluster_defects(gdf, min_overlap=DEFAULT_MIN_OVERLAP, same_type=True):
+
+    geoms = gdf.geometry.values
+    n = len(geoms)
+    parent = np.arange(n)
+    if n == 0:
+        return parent
+
+    fns = gdf["fn"].astype(str).values
+    types = gdf["type"].astype(str).values
+    areas = np.array([g.area for g in geoms])
+    bounds = [g.bounds for g in geoms]
+
+    tree = rtree_index.Index(((i, b, None) for i, b in enumerate(bounds)))
+
+    for i in range(n):
+        for j in tree.intersection(bounds[i]):
+            # Every pair once, only rows of different frames
+            if j <= i or fns[i] == fns[j] or (same_type and types[i] != types[j]):
+                continue
+            ri, rj = _find(parent, i), _find(parent, j)
+            if ri == rj:
+                continue
+            smaller = min(areas[i], areas[j])
+            if smaller > 0 and geoms[i].intersection(geoms[j]).area >= min_overlap * smaller:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    roots = np.array([_find(parent, i) for i in range(n)])
+    return np.unique(roots, return_inverse=True)[1]
+
+
+# Stable ID of every row's cluster: a hash of its representative row (the smallest by
+# filename, type and geometry), so the ID does not depend on the row order and survives
+# rebuilds as long as the representative row is there
+def defect_ids(gdf, labels):
+
+    keys = [fn + "\x00" + t + "\x00" + g.wkb_hex for fn, t, g in
+            zip(gdf["fn"].astype(str).values, gdf["type"].astype(str).values, gdf.geometry.values)]
+
+    reps = {}
+    for lbl, key in zip(labels, keys):
+        if lbl not in reps or key < reps[lbl]:
+            reps[lbl] = key
+
+    ids = {lbl: hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] for lbl, key in reps.items()}
+    return np.array([ids[lbl] for lbl in labels], dtype=object)
+
+
+# Add the defect ID column to the defect database
+def add_defect_ids(gdf, min_overlap=DEFAULT_MIN_OVERLAP, same_type=True):
+    gdf = gdf.copy()
+    gdf[DEFECT_ID_COL] = defect_ids(gdf, cluster_defects(gdf, min_overlap, same_type))
+    return gdf
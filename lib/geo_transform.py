@@ -0,0 +1,49 @@
+import numpy as np
+
+# Transforms between raster pixel coordinates and geographic coordinates
+# All functions work on whole NumPy coordinate arrays at once
+
+# The transform is kept as a GDAL style geotransform tuple
+# (x0, pixel width, row rotation, y0, column rotation, pixel height)
+# so that the geo coordinates of pixel (col, row) are
+#   gx = x0 + col * gt[1] + row * gt[2]
+#   gy = y0 + col * gt[4] + row * gt[5]
+
+
+# North-up geotransform from the extent [xmin, xmax, ymin, ymax] and the actual raster size
+def geotransform_from_extent(extent, width, height):
+    xmin, xmax, ymin, ymax = extent
+    return xmin, (xmax - xmin) / width, 0.0, ymax, 0.0, -(ymax - ymin) / height
+
+
+# Geotransform from a rasterio (affine.Affine) transform
+def geotransform_from_rasterio(transform):
+    a, b, c, d, e, f = transform[:6]
+    return c, a, b, f, d, e
+
+
+# Pixel (col, row) arrays to geo (x, y) arrays
+def pixel_to_geo(gt, cols, rows):
+    cols = np.asarray(cols, dtype=np.float64)
+    rows = np.asarray(rows, dtype=np.float64)
+    gx = gt[0] + cols * gt[1] + rows * gt[2]
+    gy = gt[3] + cols * gt[4] + rows * gt[5]
+    return gx, gy
+
+
+# Geo (x, y) arrays to pixel (col, row) arrays. These are not rounded
+def geo_to_pixel(gt, gx, gy):
+    dx = np.asarray(gx, dtype=np.float64) - gt[0]
+    dy = np.asarray(gy, dtype=np.float64) - gt[3]
+
+    # Invert the 2x2 part of the transform
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+    cols = (dx * gt[5] - dy * gt[2]) / det
+    rows = (dy * gt[1] - dx * gt[4]) / det
+    return cols, rows
+
+
+# Extent [xmin, xmax, ymin, ymax] of a raster of the given size
+def extent_from_geotransform(gt, width, height):
+    gx, gy = pixel_to_geo(gt, [0, width, width, 0], [0, 0, height, height])
+    return [float(gx.min()), float(gx.max()), float(gy.min()), float(gy.max())]
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from shapely import wkb
+
+# Geometry store: all geometries packed as WKB one after another into a single file, plus
+# an array with the start offset of every geometry (and the end of the last one).
+# Both files are memory-mapped, shapely objects are only created for the rows that are
+# asked for, so the resident memory does not grow with the size of the database
+
+GEOMETRY_BLOB_NAME = "geometry.wkb"
+GEOMETRY_OFFSETS_NAME = "geometry.offsets.npy"
+
+
+# Write the geometries to out_dir
+def write_geometry_store(geoms, out_dir):
+    offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+    with open(os.path.join(out_dir, GEOMETRY_BLOB_NAME), "wb") as f:
+        pos = 0
+        for i, g in enumerate(geoms):
+            b = g.wkb
+            f.write(b)
+            pos += len(b)
+            offsets[i + 1] = pos
+    np.save(os.path.join(out_dir, GEOMETRY_OFFSETS_NAME), offsets)
+
+
+class GeometryStore:
+
+    store_dir = None
+    offsets = None
+    blob = None
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.offsets = np.load(os.path.join(store_dir, GEOMETRY_OFFSETS_NAME), mmap_mode="r")
+
+        # An empty file cannot be memory-mapped
+        if self.offsets[-1] > 0:
+            self.blob = np.memmap(os.path.join(store_dir, GEOMETRY_BLOB_NAME), dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Materialize a single geometry
+    def __getitem__(self, row):
+        return wkb.loads(self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes())
+
+    # Materialize the geometries of the given rows
+    def get(self, rows):
+        return [self[r] for r in rows]
+
+    # Materialize everything (only for exporting the whole database)
+    def get_all(self):
+        return self.get(range(len(self)))
@@ -0,0 +1,112 @@
+import os
+import io
+import hashlib
+import numpy as np
+
+# On-disk cache of polygons (point arrays) derived from files, e.g. the frame footprint
+# contours extracted from the .mask.png files. An entry is keyed by the hash of the
+# source file contents plus the parameters of the extraction, so a changed mask or
+# changed parameters simply miss the cache. The cache is bounded by its total size on disk:
+# the least recently used entries are evicted first
+
+# Default location, shared by all the scripts of the current user
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".CentreForIntelligentSystems", "polygon_cache")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+CACHE_ENTRY_EXT = ".npy"
+
+
+# Hash file contents
+def hash_file(fn):
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PolygonCache:
+
+    cache_dir = None
+    max_bytes = None
+
+    # Approximate size of the cache, kept up to date by this process
+    size = 0
+
+    # Statistics
+    hits = 0
+    misses = 0
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(e[2] for e in self._entries())
+
+    # List of (path, mtime, size) of all entries
+    def _entries(self):
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith(CACHE_ENTRY_EXT):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, fn))
+                except OSError:
+                    continue  # Removed by another process
+                entries.append((os.path.join(self.cache_dir, fn), st.st_mtime, st.st_size))
+        return entries
+
+    # Cache key of a source file hash and the extraction parameters
+    @staticmethod
+    def make_key(file_hash, *params):
+        return hashlib.sha1((file_hash + "|" + "|".join(str(p) for p in params)).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_ENTRY_EXT)
+
+    # Returns the cached point array or None
+    def get(self, key):
+        fn = self._path(key)
+        try:
+            pts = np.load(fn)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return pts
+
+    def put(self, key, pts):
+        buf = io.BytesIO()
+        np.save(buf, np.asarray(pts))
+        data = buf.getvalue()
+
+        # Several build processes may share the cache: write to a temporary file, then rename
+        fn = self._path(key)
+        tmp_fn = fn + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_fn, "wb") as f:
+            f.write(data)
+        os.replace(tmp_fn, fn)
+
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    # Remove the least recently used entries until the cache is below 90% of the budget
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(e[2] for e in entries)
+        target = 0.9 * self.max_bytes
+        for fn, _, sz in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            self.size -= sz
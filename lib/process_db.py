@@ -1,4 +1,6 @@
+import numpy as np
 import geopandas as gpd
+import pandas as pd
 from datetime import datetime
 import time
 
@@ -8,6 +10,14 @@ import time
 # with columns {"fn": filename, "defect_type": defect_type, "geometry": geometry, "origin": image folder}
 FILE_LOOKUP_DB_COLS = ["fn", "extent", "defect_type", "origin", "geometry"]
 
+# Compact schema of the defect database: fn, type and origin are categoricals and
+# the extent list of every row is split into four float64 columns
+CATEGORICAL_COLS = ["fn", "type", "origin"]
+EXTENT_COLS = ["xmin", "xmax", "ymin", "ymax"]
+
+# ID of the physical defect a row belongs to (rows of overlapping frames, see lib/defect_clusters.py)
+DEFECT_ID_COL = "defect_id"
+
 
 # Print with timestamp
 def printt(*args):
@@ -25,4 +35,98 @@ def create_defect_geodataframe(db):
                     [fn, fn_defects[1], defs[0], thedir, defs[1]]
                 )
 
-    return gpd.GeoDataFrame(defects_list, columns=FILE_LOOKUP_DB_COLS)
\ No newline at end of file
+    return gpd.GeoDataFrame(defects_list, columns=FILE_LOOKUP_DB_COLS)
+
+
+# Join N geopandas dataframes
+def join_gdf(gdf_list, ignore_index=True):
+    if not gdf_list:
+        # Return empty geodataframe
+        return gpd.GeoDataFrame()
+
+    # Take the CRS from the first entry and check all others
+    crs = gdf_list[0].crs
+
+    # Check all the merged dataframes so that the CRS is exactly the same everywhere
+    for gdf in gdf_list:
+        if gdf.crs != crs:
+            raise ValueError("Cannot join GeoDataFrames with different CRS")
+
+    # Finally, join the geodataframes resetting the index
+    return gpd.GeoDataFrame(pd.concat(gdf_list, ignore_index=ignore_index), crs=crs)
+
+
+# Convert the defect database to the compact schema
+def compact_defect_db(gdf):
+
+    if "extent" not in gdf:
+        return gdf  # Already compact
+
+    gdf = gdf.copy()
+    for c in CATEGORICAL_COLS:
+        gdf[c] = gdf[c].astype("category")
+
+    ext = np.array(gdf["extent"].tolist(), dtype=np.float64).reshape(-1, 4)
+    for i, c in enumerate(EXTENT_COLS):
+        gdf[c] = ext[:, i]
+
+    return gdf.drop(columns="extent")
+
+
+# Compact schema with the rows of the same file kept together (sorted by filename, stable).
+# The columnar and SQLite databases and the spatial index store the rows in this order,
+# so a row number means the same defect in all of them
+def sort_defect_db(gdf):
+    gdf = compact_defect_db(gdf)
+    return gdf.sort_values("fn", kind="mergesort").reset_index(drop=True)
+
+
+# Convert the defect database from the compact schema back to the original one
+def expand_defect_db(gdf):
+
+    if "extent" in gdf:
+        return gdf  # Not compact
+
+    gdf = gdf.copy()
+    for c in CATEGORICAL_COLS:
+        gdf[c] = gdf[c].astype(object)
+
+    gdf["extent"] = gdf[EXTENT_COLS].values.tolist()
+
+    return gdf.drop(columns=EXTENT_COLS)
+
+
+# Extent [xmin, xmax, ymin, ymax] of a database row in either schema
+def get_row_extent(row):
+    if "extent" in row:
+        return row["extent"]
+    return [row[c] for c in EXTENT_COLS]
+
+
+# Statistics of the defect database: sorted vocabularies of defect types and origins,
+# number of defects per type, per origin and per origin and type.
+# Computed once by the builder and stored with the database, so the viewer need not scan it
+def compute_db_stats(gdf):
+
+    # Empty database, possibly without any columns (join_overlays of nothing)
+    if gdf.empty or "type" not in gdf or "origin" not in gdf:
+        return {"types": [], "origins": [], "type_counts": {}, "origin_counts": {}, "origin_type_counts": {}}
+
+    types = gdf["type"].astype(str)
+    origins = gdf["origin"].astype(str)
+
+    ot_counts = pd.crosstab(origins, types)
+    origin_type_counts = {o: {t: int(n) for t, n in row.items() if n > 0} for o, row in ot_counts.iterrows()}
+
+    stats = {"types": sorted(types.unique().tolist()),
+             "origins": sorted(origins.unique().tolist()),
+             "type_counts": {t: int(n) for t, n in types.value_counts().items()},
+             "origin_counts": {o: int(n) for o, n in origins.value_counts().items()},
+             "origin_type_counts": origin_type_counts}
+
+    # Number of distinct physical defects by type, if the duplicates across frames are clustered
+    if DEFECT_ID_COL in gdf:
+        stats["type_defect_counts"] = {t: int(n) for t, n in
+                                       gdf[DEFECT_ID_COL].groupby(types.values).nunique().items()}
+
+    return stats
@@ -1,55 +1,170 @@
 import numpy as np
 import cv2
-import math
 import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import patches
 
+from lib.geo_transform import geotransform_from_extent, geo_to_pixel
+from lib.tile_cache import TilePyramid, tile_cache_file
+
 # We assume the ext is ".jpg"
 ORTHOFRAME_RASTER_EXT = ".jpg"  # TODO: Potential bug here. Need to make sure we search for the file instead
 ORTHOFRAME_MASK_EXT = ".mask.png"
+ORTHOFRAME_VRT_EXT = ".vrt"
+
+# Read the crops of frames without a decoded full resolution raster as windows from disk
+# (rasterio), instead of decoding the whole raster for them
+CROP_WINDOWED_READS = True
+
+# Windowed reads are only used for crops that end above this fraction of the frame height.
+# The orthoframes are baseline JPEGs, which cannot be entered in the middle: GDAL decodes every
+# row from the top down to the bottom of the window, and it is slower at that than OpenCV's full
+# decode. A crop ending further down (the lower 40% of the frame) decodes the whole frame, which
+# is also cached for the next crops. Frames with a tile cache (USE_TILE_CACHE) read only the
+# tiles of the crop wherever it is
+CROP_WINDOW_MAX_ROW_FRACTION = 0.6
+
+# Read the frames from their tile caches (lib/tile_cache.py), where present and up to date
+USE_TILE_CACHE = True
+
+# Default memory budget of the orthoframe cache
+ORTHOFRAME_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Threads decoding orthoframes ahead of time (OpenCV releases the GIL while decoding)
+ORTHOFRAME_PREFETCH_WORKERS = 2
+
+
+# Decode flags of the reduced resolution overview (libjpeg DCT scaling for JPEGs)
+OVERVIEW_IMREAD_FLAGS = {1: cv2.IMREAD_COLOR,
+                         2: cv2.IMREAD_REDUCED_COLOR_2,
+                         4: cv2.IMREAD_REDUCED_COLOR_4,
+                         8: cv2.IMREAD_REDUCED_COLOR_8}
 
+# JPEG start of frame markers (they hold the raster size)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
 
-# The orthoframe class
+
+# Width and height of a JPEG from its header, None if it cannot be read
+def jpeg_size(fn):
+    with open(fn, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            while marker[1] == 0xFF:  # Fill bytes
+                marker = marker[1:] + f.read(1)
+            m = marker[1]
+            if m == 0x01 or 0xD0 <= m <= 0xD8:  # Markers without a segment
+                continue
+            seg = f.read(2)
+            if len(seg) < 2:
+                return None
+            seg_len = struct.unpack(">H", seg)[0]
+            if m in JPEG_SOF_MARKERS:
+                h, w = struct.unpack(">xHH", f.read(5))
+                return w, h
+            f.seek(seg_len - 2, 1)
+
+
+def read_rgb(fn, flags=cv2.IMREAD_COLOR):
+    img = cv2.imread(fn, flags)
+    if img is None:
+        raise IOError("Cannot read the image " + fn)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+# The orthoframe class.
+# With overview_scale > 1 only a reduced resolution overview is decoded up front; the full
+# resolution raster (img_content, used for the crops) is decoded when first accessed.
+# If the frame has an up to date tile cache (lib/tile_cache.py), nothing is decoded: the
+# overview and the crops are read from the tiles they touch
 class Orthoframe:
 
-    img_content = None
     geo_extent = None
+    geotransform = None
     shape = None
+    overview_scale = 1
+    tile_pyramid = None
 
-    def __init__(self, file_path, fn, extent):
-
-        full_raster_path = file_path + os.sep + fn + ORTHOFRAME_RASTER_EXT
-
-        img = cv2.imread(full_raster_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def __init__(self, file_path, fn, extent, overview_scale=1):
 
-        # Store the image content and other meta
-        self.img_content = img
+        self.raster_path = file_path + os.sep + fn + ORTHOFRAME_RASTER_EXT
         self.geo_extent = extent
-        self.shape = img.shape
+        self._img_content = None
+        self._overview = None
 
-    def transform_from_geo_coordinates(self, geoxy):
+        tiles_fn = tile_cache_file(self.raster_path)
+        if USE_TILE_CACHE and os.path.isfile(tiles_fn) and \
+                os.path.getmtime(tiles_fn) >= os.path.getmtime(self.raster_path):
+            # Tile cache: the overview is read from the closest level of the pyramid
+            self.tile_pyramid = TilePyramid(tiles_fn)
+            self.shape = (self.tile_pyramid.height, self.tile_pyramid.width, 3)
+            if overview_scale > 1:
+                level = self.tile_pyramid.level_of_scale(overview_scale)
+                self.overview_scale = 2 ** level
+                self._overview = self.tile_pyramid.read_level(level)
+        else:
+            size = jpeg_size(self.raster_path) if overview_scale > 1 else None
+            if size is None:
+                # Full decode
+                self.overview_scale = 1
+                self._img_content = read_rgb(self.raster_path)
+                self.shape = self._img_content.shape
+            else:
+                self.overview_scale = overview_scale
+                self._overview = read_rgb(self.raster_path, OVERVIEW_IMREAD_FLAGS[overview_scale])
+                self.shape = (size[1], size[0], 3)
 
-        # Get data from tuple
-        x, y = geoxy
-        xmin, xmax, ymin, ymax = self.geo_extent
+        # Transform of the actual (full) raster size
         h, w, _ = self.shape
+        self.geotransform = geotransform_from_extent(extent, w, h)
+
+    # Full resolution raster, decoded (or read from the tile cache) when first needed
+    @property
+    def img_content(self):
+        if self._img_content is None:
+            if self.tile_pyramid is not None:
+                self._img_content = self.tile_pyramid.read_level(0)
+            else:
+                self._img_content = read_rgb(self.raster_path)
+        return self._img_content
 
-        bx = (x - xmin) / (xmax - xmin)
-        by = 1 - (y - ymin) / (ymax - ymin)
+    # Raster for displaying the whole frame: the reduced resolution one, if it was decoded
+    @property
+    def overview(self):
+        return self._overview if self._overview is not None else self.img_content
 
-        bxp = math.floor(w * bx)
-        byp = math.floor(h * by)
+    # Drop the full resolution raster (it is decoded again when needed)
+    def release_full_resolution(self):
+        if self._overview is not None or self.tile_pyramid is not None:
+            self._img_content = None
 
-        return bxp, byp
+    # Memory held by the decoded rasters
+    @property
+    def nbytes(self):
+        return sum(img.nbytes for img in (self._img_content, self._overview) if img is not None)
+
+    # Transform geo coordinate arrays to pixel coordinate arrays
+    def transform_from_geo_coordinates_array(self, gx, gy):
+        cols, rows = geo_to_pixel(self.geotransform, gx, gy)
+        return np.floor(cols).astype(int), np.floor(rows).astype(int)
+
+    def transform_from_geo_coordinates(self, geoxy):
+        cols, rows = self.transform_from_geo_coordinates_array(geoxy[0], geoxy[1])
+        return int(cols), int(rows)
 
     def bounds_transform_from_geo_coordinates(self, geopatch):
         x1, y1, x2, y2 = geopatch
-        bx1p, by1p = self.transform_from_geo_coordinates((x1, y1))
-        bx2p, by2p = self.transform_from_geo_coordinates((x2, y2))
-        return bx1p, bx2p, by1p, by2p
+        (bx1p, bx2p), (by1p, by2p) = self.transform_from_geo_coordinates_array([x1, x2], [y1, y2])
+        return int(bx1p), int(bx2p), int(by1p), int(by2p)
 
-    def bounds_crop_img(self, geopatch):
+    # Pixel window (x1, x2, y1, y2) of a geo box, ordered and clipped to the raster
+    def bounds_window(self, geopatch):
         x1, x2, y1, y2 = self.bounds_transform_from_geo_coordinates(geopatch)
 
         # Make sure ranges are adequate
@@ -59,4 +174,196 @@ class Orthoframe:
         if x1 > x2:
             x1, x2 = x2, x1
 
+        h, w, _ = self.shape
+        return min(max(x1, 0), w), min(max(x2, 0), w), min(max(y1, 0), h), min(max(y2, 0), h)
+
+    # Crop of a geo box. If the full resolution raster is not decoded, only the window
+    # is read from disk (through the VRT of the frame, if there is one)
+    def bounds_crop_img(self, geopatch):
+        x1, x2, y1, y2 = self.bounds_window(geopatch)
+        if self._img_content is None and self.tile_pyramid is not None:
+            return self.tile_pyramid.read_window(x1, x2, y1, y2)
+        if self.use_windowed_read(y2):
+            return read_window_rgb(self.window_source(), x1, x2, y1, y2)
         return self.img_content[y1:y2, x1:x2, ...]
+
+    # Whether reading a window reaching down to the bottom row is cheaper than the full decode
+    def use_windowed_read(self, bottom_row):
+        return CROP_WINDOWED_READS and self._img_content is None and \
+            bottom_row <= CROP_WINDOW_MAX_ROW_FRACTION * self.shape[0]
+
+    # File the windows are read from: the VRT of the frame if present, the raster otherwise
+    def window_source(self):
+        vrt = os.path.splitext(self.raster_path)[0] + ORTHOFRAME_VRT_EXT
+        return vrt if os.path.isfile(vrt) else self.raster_path
+
+
+# Read a pixel window (x1, x2, y1, y2) of a raster as an RGB image with rasterio (GDAL),
+# without decoding the rest of the raster. Single band rasters are returned as gray RGB
+def read_window_rgb(fn, x1, x2, y1, y2):
+    if x2 <= x1 or y2 <= y1:
+        return np.zeros((max(y2 - y1, 0), max(x2 - x1, 0), 3), dtype=np.uint8)
+
+    import rasterio  # Only needed for the windowed reads
+    from rasterio.windows import Window
+
+    with rasterio.open(fn) as ds:
+        bands = [1, 2, 3] if ds.count >= 3 else [1, 1, 1]
+        data = ds.read(bands, window=Window(x1, y1, x2 - x1, y2 - y1))
+    return np.ascontiguousarray(np.transpose(data, (1, 2, 0)))
+
+
+# Cache of decoded orthoframes, least recently used ones are dropped first
+# once the decoded rasters take more than max_bytes.
+# The cache is thread-safe: a frame requested while another thread (the prefetcher)
+# is decoding it is waited for instead of being decoded twice.
+# With overview_scale > 1 the frames hold the reduced resolution overview, and only the
+# frame last returned by get keeps its full resolution raster
+class OrthoframeCache:
+
+    max_bytes = ORTHOFRAME_CACHE_MAX_BYTES
+    overview_scale = 1
+    hits = 0
+    misses = 0
+    prefetched = 0
+
+    def __init__(self, max_bytes=ORTHOFRAME_CACHE_MAX_BYTES, overview_scale=1):
+        self.max_bytes = max_bytes
+        self.overview_scale = overview_scale
+        self.frames = OrderedDict()
+        self.lock = threading.RLock()  # Reentrant: put and evict take it again under get
+        self.loading = {}  # key -> Event set when the decode is done
+
+    @staticmethod
+    def make_key(file_path, fn, extent):
+        return file_path, fn, tuple(extent)
+
+    # The orthoframe from the cache or, if it is not there, decoded and added to the cache
+    def get(self, file_path, fn, extent):
+        frame, hit = self._load(file_path, fn, extent)
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            for f in self.frames.values():
+                if f is not frame:
+                    f.release_full_resolution()
+        return frame
+
+    # Decode the orthoframe into the cache in advance (called from the prefetch threads)
+    def prefetch(self, file_path, fn, extent):
+        _, hit = self._load(file_path, fn, extent)
+        if not hit:
+            with self.lock:
+                self.prefetched += 1
+
+    # Returns the frame and whether it was in the cache (or being decoded) already
+    def _load(self, file_path, fn, extent):
+        key = self.make_key(file_path, fn, extent)
+
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+                return frame, True
+            event = self.loading.get(key)
+            if event is None:
+                self.loading[key] = threading.Event()
+
+        # Another thread is decoding it
+        if event is not None:
+            event.wait()
+            with self.lock:
+                frame = self.frames.get(key)
+            if frame is not None:
+                return frame, True
+            return self._load(file_path, fn, extent)
+
+        try:
+            frame = Orthoframe(file_path, fn, extent, self.overview_scale)
+            with self.lock:
+                self.put(key, frame)
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+        return frame, False
+
+    # Memory held by the cached frames (the full resolution rasters come and go, so it is summed up)
+    @property
+    def nbytes(self):
+        with self.lock:
+            return sum(f.nbytes for f in self.frames.values())
+
+    # Add a frame (the lock must be held)
+    def put(self, key, frame):
+        self.frames.pop(key, None)
+        self.frames[key] = frame
+        self.evict()
+
+    # Drop the least recently used frames until within the budget (the newest one is always kept)
+    def evict(self):
+        nbytes = self.nbytes
+        while nbytes > self.max_bytes and len(self.frames) > 1:
+            _, frame = self.frames.popitem(last=False)
+            nbytes -= frame.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.frames)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.frames
+
+    def stats_line(self):
+        with self.lock:
+            return "Orthoframe cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + \
+                   str(self.prefetched) + " prefetched, " + str(len(self.frames)) + " frames, " + \
+                   str(self.nbytes // (1024 * 1024)) + " MB"
+
+
+# Decodes orthoframes into the cache on a thread pool ahead of time.
+# A new request replaces the previous one: the frames not wanted anymore that have
+# not started decoding yet are cancelled
+class OrthoframePrefetcher:
+
+    cache = None
+
+    def __init__(self, cache, workers=ORTHOFRAME_PREFETCH_WORKERS):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}  # key -> Future
+
+    # frames is a list of (file_path, fn, extent) in the order they should be decoded
+    def prefetch(self, frames):
+        keys = [self.cache.make_key(*f) for f in frames]
+
+        # Forget the finished ones and cancel the stale ones
+        for key, fut in list(self.pending.items()):
+            if fut.done() or (key not in keys and fut.cancel()):
+                del self.pending[key]
+
+        for key, f in zip(keys, frames):
+            if key not in self.pending and key not in self.cache:
+                self.pending[key] = self.executor.submit(self._decode, *f)
+
+    def _decode(self, file_path, fn, extent):
+        try:
+            self.cache.prefetch(file_path, fn, extent)
+        except Exception as err:
+            print("Could not prefetch " + fn + ": " + str(err))
+
+    # Cancel everything that has not started yet
+    def cancel(self):
+        for fut in self.pending.values():
+            fut.cancel()
+        self.pending = {}
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
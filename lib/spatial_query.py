@@ -0,0 +1,151 @@
+import os
+import io
+import json
+import numpy as np
+from rtree import index as rtree_index
+from shapely.geometry import box, Point
+from shapely.prepared import prep
+
+from lib.process_db import sort_defect_db, EXTENT_COLS
+from lib.geometry_store import GeometryStore, write_geometry_store
+
+# Spatial queries over all annotated defects.
+# The spatial index is a directory with
+#   spatial_index.json     header: row count and the frame (file) names
+#   defects.dat/.idx       R-tree over the bounding boxes of the defect geometries (id = row)
+#   frames.dat/.idx        R-tree over the frame footprints (id = frame ID)
+#   row_frames.npy         frame ID of every row
+#   geometry.wkb, geometry.offsets.npy   the defect geometries (see lib/geometry_store.py)
+# The R-trees are bulk loaded (sort-tile-recursive packing, the same as STRtree) and kept on
+# disk, so opening the index is instant. The bounding box candidates are refined with the
+# exact geometries, which are only read for the candidates.
+# Rows are in the order of process_db.sort_defect_db, the same as in the columnar and SQLite
+# databases; frame IDs are positions in the sorted list of filenames
+
+SPATIAL_INDEX_HEADER_NAME = "spatial_index.json"
+DEFECTS_RTREE_NAME = "defects"
+FRAMES_RTREE_NAME = "frames"
+ROW_FRAMES_NAME = "row_frames.npy"
+
+# Page size of the R-tree nodes (entries per node)
+RTREE_LEAF_CAPACITY = 64
+
+
+def _rtree_properties():
+    p = rtree_index.Property()
+    p.leaf_capacity = RTREE_LEAF_CAPACITY
+    p.index_capacity = RTREE_LEAF_CAPACITY
+    p.overwrite = True
+    return p
+
+
+# Bulk load an R-tree to disk from an array of bounds (minx, miny, maxx, maxy)
+def _write_rtree(basename, bounds):
+    stream = ((i, tuple(b), None) for i, b in enumerate(bounds))
+    idx = rtree_index.Index(basename, stream, properties=_rtree_properties()) if len(bounds) \
+        else rtree_index.Index(basename, properties=_rtree_properties())
+    idx.close()
+
+
+# Build the spatial index of the defect database (GeoDataFrame) into out_dir
+def build_spatial_index(gdf, out_dir):
+
+    os.makedirs(out_dir, exist_ok=True)
+    gdf = sort_defect_db(gdf)
+
+    # The header is written last, an existing header means the index is complete
+    header_fn = os.path.join(out_dir, SPATIAL_INDEX_HEADER_NAME)
+    if os.path.isfile(header_fn):
+        os.remove(header_fn)
+
+    geoms = gdf.geometry.values
+    write_geometry_store(geoms, out_dir)
+    _write_rtree(os.path.join(out_dir, DEFECTS_RTREE_NAME), np.array([g.bounds for g in geoms]).reshape(-1, 4))
+
+    # One footprint per frame: the extent of the orthoframe
+    fn = gdf["fn"].astype("category")
+    frame_names = fn.cat.categories.tolist()
+    row_frames = fn.cat.codes.values.astype(np.int32)
+    np.save(os.path.join(out_dir, ROW_FRAMES_NAME), row_frames)
+
+    first_rows = np.searchsorted(row_frames, np.arange(len(frame_names)))
+    ext = gdf[EXTENT_COLS].values[first_rows]
+    _write_rtree(os.path.join(out_dir, FRAMES_RTREE_NAME), ext[:, [0, 2, 1, 3]])
+
+    header = {"n_rows": len(gdf), "frames": frame_names, "frame_extents": ext.tolist()}
+    with io.open(header_fn, "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+
+
+# Spatial queries on an index written by build_spatial_index. Defect queries return
+# (rows, frame IDs of the rows), both sorted by row; frame queries return frame IDs
+class SpatialIndex:
+
+    index_dir = None
+    n_rows = 0
+    frames = None
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with io.open(os.path.join(index_dir, SPATIAL_INDEX_HEADER_NAME), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        self.n_rows = header["n_rows"]
+        self.frames = header["frames"]
+        self.frame_extents = np.array(header["frame_extents"], dtype=np.float64).reshape(-1, 4)
+        self.row_frames = np.load(os.path.join(index_dir, ROW_FRAMES_NAME), mmap_mode="r")
+        self.geometries = GeometryStore(index_dir)
+        self.defects_tree = rtree_index.Index(os.path.join(index_dir, DEFECTS_RTREE_NAME))
+        self.frames_tree = rtree_index.Index(os.path.join(index_dir, FRAMES_RTREE_NAME))
+
+    def close(self):
+        self.defects_tree.close()
+        self.frames_tree.close()
+
+    def _result(self, rows):
+        rows = np.sort(np.asarray(list(rows), dtype=np.int64))
+        return rows, np.asarray(self.row_frames[rows], dtype=np.int32)
+
+    # Rows whose bounding box intersects the box
+    def _candidates(self, xmin, ymin, xmax, ymax):
+        return self.defects_tree.intersection((xmin, ymin, xmax, ymax))
+
+    # Defects intersecting the box
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        return self.query_polygon(box(xmin, ymin, xmax, ymax))
+
+    # Defects intersecting the polygon (or any other shapely geometry)
+    def query_polygon(self, poly):
+        pg = prep(poly)
+        return self._result(r for r in self._candidates(*poly.bounds) if pg.intersects(self.geometries[r]))
+
+    # Defects within radius of the point
+    def query_radius(self, x, y, radius):
+        pt = Point(x, y)
+        return self._result(r for r in self._candidates(x - radius, y - radius, x + radius, y + radius)
+                            if self.geometries[r].distance(pt) <= radius)
+
+    # k defects nearest to the point (exact distance to the geometry; ties may give more than k)
+    def query_nearest(self, x, y, k=1):
+        if self.n_rows == 0:
+            return self._result([])
+        pt = Point(x, y)
+
+        # The bounding box distance is a lower bound of the geometry distance: the k nearest
+        # boxes give an upper bound of the k-th distance, within which all the answers lie
+        rows = list(self.defects_tree.nearest((x, y, x, y), k))
+        bound = sorted(self.geometries[r].distance(pt) for r in rows)[min(k, len(rows)) - 1]
+        cand = list(self._candidates(x - bound, y - bound, x + bound, y + bound))
+        dist = np.array([self.geometries[r].distance(pt) for r in cand])
+        kth = np.sort(dist)[min(k, len(cand)) - 1]
+        return self._result(r for r, d in zip(cand, dist) if d <= kth)
+
+    # Frames whose footprint intersects the geometry
+    def query_frames(self, geom):
+        pg = prep(geom)
+        ids = [i for i in self.frames_tree.intersection(geom.bounds)
+               if pg.intersects(box(*self.frame_extents[i][[0, 2, 1, 3]]))]
+        return np.sort(np.asarray(ids, dtype=np.int32))
+
+    # Filenames of frame IDs
+    def frame_names(self, frame_ids):
+        return [self.frames[i] for i in frame_ids]
@@ -0,0 +1,192 @@
+import os
+import json
+import sqlite3
+import pathlib
+import numpy as np
+import pandas as pd
+from shapely import wkb
+
+from lib.process_db import sort_defect_db, compute_db_stats, CATEGORICAL_COLS, EXTENT_COLS
+
+# SQLite storage backend of the defect database: a single file that is queried on demand,
+# so the database need not fit in memory. Tables:
+#   defects       one row per defect: the row number (_rowid), fn, origin, type, the frame extent
+#                 (xmin, xmax, ymin, ymax), any other attribute columns and the geometry as WKB.
+#                 Rows are ordered by fn
+#   defects_bbox  R-tree over the bounding boxes of the defect geometries (id = defects._rowid).
+#                 The R-tree stores 32-bit floats, so its results are refined with the exact bounds
+#   db_info       key -> JSON value: metadata, CRS and the precomputed statistics
+# fn, origin and type are indexed. Plain SQLite with the R-tree module is used rather than
+# SpatiaLite, so no extension has to be installed on the analysts' machines
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+INSERT_BATCH_SIZE = 50000
+
+# Row number column of the defects table, named so that it cannot clash with a shapefile attribute
+ROW_ID_COL = "_rowid"
+
+
+# Is the file an SQLite database?
+def is_sqlite_db(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def _sql_type(col):
+    if pd.api.types.is_integer_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(col.dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def _sql_value(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+# Write the defect database (GeoDataFrame) to an SQLite file, replacing an existing one.
+# meta is a dict of additional information, stats are the precomputed statistics
+def write_sqlite_db(gdf, db_file, meta=None, stats=None):
+
+    gdf = sort_defect_db(gdf)
+    geom_col = gdf.geometry.name
+    attr_cols = [c for c in gdf.columns if c != geom_col]
+    if ROW_ID_COL in attr_cols or "geometry" in attr_cols:
+        raise ValueError("The defect database has a reserved column name: " + ROW_ID_COL + " or geometry")
+
+    # Built under a temporary name, so a failed write leaves no partial database
+    tmp_file = db_file + ".tmp"
+    if os.path.isfile(tmp_file):
+        os.remove(tmp_file)
+
+    con = sqlite3.connect(tmp_file)
+    try:
+        col_defs = ", ".join(['"' + c + '" ' + _sql_type(gdf[c]) for c in attr_cols])
+        con.execute("CREATE TABLE defects (" + ROW_ID_COL + " INTEGER PRIMARY KEY, " + col_defs + ", geometry BLOB)")
+        con.execute("CREATE VIRTUAL TABLE defects_bbox USING rtree(id, minx, maxx, miny, maxy)")
+        con.execute("CREATE TABLE db_info (key TEXT PRIMARY KEY, value TEXT)")
+
+        insert_sql = "INSERT INTO defects VALUES (?, " + ", ".join(["?"] * len(attr_cols)) + ", ?)"
+        for start in range(0, len(gdf), INSERT_BATCH_SIZE):
+            part = gdf.iloc[start:start + INSERT_BATCH_SIZE]
+            attrs = [part[c].astype(object).tolist() if c in CATEGORICAL_COLS else
+                     [_sql_value(v) for v in part[c].values] for c in attr_cols]
+            geoms = part[geom_col].values
+            ids = range(start, start + len(part))
+            con.executemany(insert_sql, ([i] + [a[k] for a in attrs] + [g.wkb]
+                                         for k, (i, g) in enumerate(zip(ids, geoms))))
+            con.executemany("INSERT INTO defects_bbox VALUES (?, ?, ?, ?, ?)",
+                            ((i, b[0], b[2], b[1], b[3]) for i, b in zip(ids, [g.bounds for g in geoms])))
+
+        for c in CATEGORICAL_COLS:
+            con.execute('CREATE INDEX "idx_defects_' + c + '" ON defects ("' + c + '")')
+
+        crs = gdf.crs.to_string() if gdf.crs is not None and not isinstance(gdf.crs, (dict, str)) else gdf.crs
+        info = {"meta": meta if meta is not None else {}, "crs": crs,
+                "stats": stats if stats is not None else compute_db_stats(gdf)}
+        con.executemany("INSERT INTO db_info VALUES (?, ?)",
+                        [(k, json.dumps(v, ensure_ascii=False)) for k, v in info.items()])
+        con.commit()
+    finally:
+        con.close()
+
+    os.replace(tmp_file, db_file)
+
+
+# Reader of the SQLite database. Nothing is loaded up front, every call is a query
+class SqliteDb:
+
+    db_file = None
+    meta = None
+    crs = None
+    stats = None
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+
+        # Read-only; the connection may be used by the thread that did not open it (the loader).
+        # as_uri escapes the characters that have a meaning in a URI and handles drive letters
+        uri = pathlib.Path(db_file).resolve().as_uri() + "?mode=ro"
+        self.con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+        info = {k: json.loads(v) for k, v in self.con.execute("SELECT key, value FROM db_info")}
+        self.meta = info.get("meta", {})
+        self.crs = info.get("crs")
+        self.stats = info.get("stats")
+        if self.stats is None:
+            self.stats = self.compute_stats()
+
+    def close(self):
+        self.con.close()
+
+    @property
+    def n_rows(self):
+        return self.con.execute("SELECT COUNT(*) FROM defects").fetchone()[0]
+
+    # Sorted distinct values of an indexed column
+    def vocabulary(self, col):
+        return [r[0] for r in self.con.execute('SELECT DISTINCT "' + col + '" FROM defects ORDER BY 1')]
+
+    # Statistics (same as process_db.compute_db_stats) from GROUP BY queries
+    def compute_stats(self):
+        ot = self.con.execute("SELECT origin, type, COUNT(*) FROM defects GROUP BY origin, type").fetchall()
+        stats = {"types": self.vocabulary("type"), "origins": self.vocabulary("origin"),
+                 "type_counts": {}, "origin_counts": {}, "origin_type_counts": {}}
+        for o, t, n in ot:
+            stats["type_counts"][t] = stats["type_counts"].get(t, 0) + n
+            stats["origin_counts"][o] = stats["origin_counts"].get(o, 0) + n
+            stats["origin_type_counts"].setdefault(o, {})[t] = n
+        return stats
+
+    # Names of the files matching all the filters (dict column -> value), in filename order
+    def files(self, filters):
+        where = " AND ".join(['"' + c + '" = ?' for c in filters])
+        sql = "SELECT DISTINCT fn FROM defects" + (" WHERE " + where if where else "") + " ORDER BY fn"
+        return [r[0] for r in self.con.execute(sql, list(filters.values()))]
+
+    # Defects of a file as a DataFrame with a materialized geometry column
+    def file_defects(self, fn, only_type=None):
+        sql = "SELECT * FROM defects WHERE fn = ?"
+        args = [fn]
+        if only_type is not None:
+            sql += " AND type = ?"
+            args.append(only_type)
+        return self._query_df(sql + " ORDER BY " + ROW_ID_COL, args)
+
+    # Defects whose bounding box intersects the given box. The R-tree boxes are rounded outwards
+    # to 32-bit floats (~0.5 m at the coordinates of EPSG:3301), so the candidates are a superset;
+    # they are filtered with the exact bounds of the geometries
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        df = self._query_df("SELECT d.* FROM defects d JOIN defects_bbox b ON d." + ROW_ID_COL + " = b.id "
+                            "WHERE b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ? "
+                            "ORDER BY d." + ROW_ID_COL, [xmax, xmin, ymax, ymin])
+        bounds = np.array([g.bounds for g in df["geometry"]], dtype=np.float64).reshape(-1, 4)
+        exact = (bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin)
+        return df[exact]
+
+    def _query_df(self, sql, args):
+        cur = self.con.execute(sql, args)
+        df = pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+        df["geometry"] = [wkb.loads(g) for g in df["geometry"]]
+        return df.set_index(ROW_ID_COL)
+
+    # File entry in the form the viewer uses: {"fn", "origin", "extent", "defects": [(type, geometry)]}
+    def file_entry(self, fn, only_type=None):
+        frame = self.file_frame(fn)
+        if frame is None:
+            return None
+        defects = self.file_defects(fn, only_type)
+        return {"fn": fn, "origin": frame[0], "extent": frame[1],
+                "defects": list(zip(defects["type"], defects["geometry"]))}
+
+    # Origin and extent of the file
+    def file_frame(self, fn):
+        extent_sql = "SELECT origin, " + ", ".join(EXTENT_COLS) + " FROM defects WHERE fn = ? LIMIT 1"
+        first = self.con.execute(extent_sql, [fn]).fetchone()
+        if first is None:
+            return None
+        return first[0], list(first[1:])
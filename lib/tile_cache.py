@@ -0,0 +1,141 @@
+import os
+import io
+import json
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+
+# Tiled pyramid cache of the orthoframe rasters.
+# Every frame is written once into <frame>.tiles next to the original JPEG: a JSON header
+# padded to HEADER_BYTES, then the levels of the pyramid (level l is reduced 2**l times,
+# down to a single tile), each stored tile by tile as raw RGB uint8. The file is memory-mapped,
+# so the overview and the crops read only the tiles they touch
+
+TILE_CACHE_EXT = ".tiles"
+TILE_SIZE = 256
+HEADER_BYTES = 4096
+TILE_CACHE_MAGIC = "ORTHOFRAME_TILES"
+TILE_CACHE_VERSION = 1
+
+
+# Tile cache file of a raster
+def tile_cache_file(raster_path):
+    return os.path.splitext(raster_path)[0] + TILE_CACHE_EXT
+
+
+# Split an image into tiles: (rows of tiles, columns of tiles, tile, tile, 3), zero padded
+def _to_tiles(img, tile_size):
+    h, w = img.shape[:2]
+    ny, nx = -(-h // tile_size), -(-w // tile_size)
+    padded = np.zeros((ny * tile_size, nx * tile_size, 3), dtype=np.uint8)
+    padded[:h, :w] = img
+    return np.ascontiguousarray(padded.reshape(ny, tile_size, nx, tile_size, 3).transpose(0, 2, 1, 3, 4))
+
+
+# Write the pyramid of an RGB image to out_fn (atomically)
+def write_tile_pyramid(img, out_fn, tile_size=TILE_SIZE):
+
+    header = {"magic": TILE_CACHE_MAGIC, "version": TILE_CACHE_VERSION, "tile_size": tile_size,
+              "width": img.shape[1], "height": img.shape[0], "levels": []}
+
+    tmp_fn = out_fn + ".tmp"
+    with open(tmp_fn, "wb") as f:
+        f.seek(HEADER_BYTES)
+        level = img
+        while True:
+            tiles = _to_tiles(level, tile_size)
+            header["levels"].append({"width": level.shape[1], "height": level.shape[0],
+                                     "ny": tiles.shape[0], "nx": tiles.shape[1], "offset": f.tell()})
+            f.write(tiles.tobytes())
+            if max(level.shape[:2]) <= tile_size:
+                break
+            level = cv2.resize(level, ((level.shape[1] + 1) // 2, (level.shape[0] + 1) // 2),
+                               interpolation=cv2.INTER_AREA)
+
+        header_bytes = json.dumps(header).encode("utf-8")
+        if len(header_bytes) > HEADER_BYTES:
+            raise ValueError("Tile cache header does not fit in " + str(HEADER_BYTES) + " bytes")
+        f.seek(0)
+        f.write(header_bytes.ljust(HEADER_BYTES, b" "))
+
+    os.replace(tmp_fn, out_fn)
+
+
+# Convert a raster (JPEG) into its tile cache, unless the cache is newer than the raster.
+# Returns True if the cache was written
+def convert_raster(raster_path, overwrite=False):
+    out_fn = tile_cache_file(raster_path)
+    if not overwrite and os.path.isfile(out_fn) and os.path.getmtime(out_fn) >= os.path.getmtime(raster_path):
+        return False
+    img = cv2.imread(raster_path)
+    if img is None:
+        raise IOError("Cannot read the image " + raster_path)
+    write_tile_pyramid(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), out_fn)
+    return True
+
+
+# Convert all rasters with the extension ext in the folder, in a process pool.
+# Returns the number of rasters converted
+def convert_folder(path, ext=".jpg", workers=None, overwrite=False):
+    rasters = [os.path.join(path, fn) for fn in sorted(os.listdir(path)) if fn.endswith(ext)]
+    if workers == 1:
+        return sum(convert_raster(r, overwrite) for r in rasters)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return sum(ex.map(convert_raster, rasters, [overwrite] * len(rasters), chunksize=8))
+
+
+# Memory-mapped tile pyramid of one raster
+class TilePyramid:
+
+    fn = None
+    width = 0
+    height = 0
+    tile_size = TILE_SIZE
+
+    def __init__(self, fn):
+        self.fn = fn
+        with io.open(fn, "rb") as f:
+            header = json.loads(f.read(HEADER_BYTES).decode("utf-8"))
+        if header.get("magic") != TILE_CACHE_MAGIC or header["version"] > TILE_CACHE_VERSION:
+            raise ValueError("Not a supported tile cache: " + fn)
+
+        self.width = header["width"]
+        self.height = header["height"]
+        self.tile_size = header["tile_size"]
+        self.levels = header["levels"]
+        t = self.tile_size
+        self.tiles = [np.memmap(fn, dtype=np.uint8, mode="r", offset=lv["offset"],
+                                shape=(lv["ny"], lv["nx"], t, t, 3)) for lv in self.levels]
+
+    @property
+    def n_levels(self):
+        return len(self.levels)
+
+    # Level reduced by the given factor (a power of two), the coarsest one if there is none
+    def level_of_scale(self, scale):
+        return min(int(round(np.log2(max(scale, 1)))), self.n_levels - 1)
+
+    # Pixel window (x1, x2, y1, y2, in the pixels of the level) as an RGB image
+    def read_window(self, x1, x2, y1, y2, level=0):
+        lv = self.levels[level]
+        x1, x2 = max(x1, 0), min(x2, lv["width"])
+        y1, y2 = max(y1, 0), min(y2, lv["height"])
+        out = np.zeros((max(y2 - y1, 0), max(x2 - x1, 0), 3), dtype=np.uint8)
+        if out.size == 0:
+            return out
+
+        t = self.tile_size
+        tiles = self.tiles[level]
+        for ty in range(y1 // t, (y2 - 1) // t + 1):
+            for tx in range(x1 // t, (x2 - 1) // t + 1):
+                # Part of the window inside this tile
+                wy1, wy2 = max(y1, ty * t), min(y2, (ty + 1) * t)
+                wx1, wx2 = max(x1, tx * t), min(x2, (tx + 1) * t)
+                out[wy1 - y1:wy2 - y1, wx1 - x1:wx2 - x1] = \
+                    tiles[ty, tx, wy1 - ty * t:wy2 - ty * t, wx1 - tx * t:wx2 - tx * t]
+        return out
+
+    # The whole level as an RGB image
+    def read_level(self, level):
+        lv = self.levels[level]
+        return self.read_window(0, lv["width"], 0, lv["height"], level)
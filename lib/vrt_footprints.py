@@ -0,0 +1,100 @@
+import os
+import pickle
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.geo_transform import geotransform_from_rasterio
+
+# Fast scanning of orthoframe VRT metadata (geotransform and raster size)
+# The VRT is a small XML file, so the metadata is parsed straight from it instead of
+# opening the dataset with rasterio/GDAL. The results are stored in a footprint catalog
+# in every folder, so that later builds and tools need not scan the folder again
+
+# Catalog file name
+FOOTPRINT_CATALOG_NAME = "footprint_catalog.pkl"
+
+# Threads used for scanning
+SCAN_WORKERS = 8
+
+
+# Parse the geotransform and the raster size from the VRT XML.
+# Returns (geotransform, width, height) or None if the VRT cannot be parsed
+def parse_vrt(fn):
+    try:
+        root = ET.parse(fn).getroot()
+        gt = tuple(float(v) for v in root.find("GeoTransform").text.split(","))
+        if len(gt) != 6:
+            return None
+        return gt, int(root.attrib["rasterXSize"]), int(root.attrib["rasterYSize"])
+    except (ET.ParseError, AttributeError, KeyError, ValueError):
+        return None
+
+
+# Get the VRT metadata: from the XML if possible, with rasterio otherwise
+def scan_vrt(fn):
+    meta = parse_vrt(fn)
+    if meta is None:
+        import rasterio  # Only needed for the fallback
+        with rasterio.open(fn) as rvrt:
+            meta = geotransform_from_rasterio(rvrt.transform), rvrt.width, rvrt.height
+    return meta
+
+
+def load_catalog(path):
+    fn = os.path.join(path, FOOTPRINT_CATALOG_NAME)
+    if not os.path.isfile(fn):
+        return {}
+    try:
+        with open(fn, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # A broken catalog is simply rebuilt
+        return {}
+
+
+def save_catalog(path, catalog):
+    fn = os.path.join(path, FOOTPRINT_CATALOG_NAME)
+
+    # Write to a temporary file first so that readers never see a partial catalog
+    with open(fn + ".tmp", "wb") as f:
+        pickle.dump(catalog, f)
+    os.replace(fn + ".tmp", fn)
+
+
+# Scan the VRTs of a folder. If vrts is None, all VRTs in the folder are scanned.
+# Catalog entries are reused as long as the size and mtime of the VRT match.
+# Returns {vrt name: (geotransform, width, height)}
+def scan_vrt_folder(path, vrts=None, workers=SCAN_WORKERS, update_catalog=True):
+
+    catalog = load_catalog(path)
+
+    if vrts is None:
+        vrts = sorted([vrt for vrt in os.listdir(path) if vrt.endswith(".vrt")])
+
+        # Forget the VRTs that are gone
+        gone = [vrt for vrt in catalog if vrt not in vrts]
+        for vrt in gone:
+            del catalog[vrt]
+        if gone and update_catalog:
+            save_catalog(path, catalog)
+
+    # Catalog entry: (size, mtime, geotransform, width, height)
+    stats = {}
+    to_scan = []
+    for vrt in vrts:
+        st = os.stat(os.path.join(path, vrt))
+        stats[vrt] = (st.st_size, st.st_mtime)
+        if catalog.get(vrt, (None, None))[:2] != stats[vrt]:
+            to_scan.append(vrt)
+
+    if to_scan:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            metas = list(executor.map(scan_vrt, [os.path.join(path, vrt) for vrt in to_scan]))
+
+        for vrt, meta in zip(to_scan, metas):
+            catalog[vrt] = stats[vrt] + tuple(meta)
+
+        if update_catalog:
+            save_catalog(path, catalog)
+
+    return {vrt: catalog[vrt][2:] for vrt in vrts}
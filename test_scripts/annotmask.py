@@ -1,7 +1,9 @@
 import cv2
 import numpy as np
+from shapely.geometry import Point, Polygon
 
 MID_POINT = (2048, 2048)
+MID_RADIUS = 1500
 
 # Expected shape: (h,w,1)
 def get_sqround_mask(mask):
@@ -19,13 +21,51 @@ def get_sqround_mask(mask):
     box = newbox(box)
 
     rdmask = np.zeros(mask.shape, np.uint8)
-    rdmask = cv2.circle(rdmask, MID_POINT, 1500, (255), -1)
+    rdmask = cv2.circle(rdmask, MID_POINT, MID_RADIUS, (255), -1)
     cv2.drawContours(rdmask, [box], 0, (255, 255, 255), -1)
 
     finalmask = cv2.bitwise_and(mask, rdmask)
 
     return finalmask
 
+# Same narrowing as get_sqround_mask, but computed on vectors: the mask polygon is intersected
+# with the union of the circle and the shrunken box, so no extra full-size rasters are drawn.
+# Returns the narrowed footprint as a shapely Polygon in pixel coordinates (x, y),
+# an empty Polygon if nothing of the mask is left
+def get_sqround_polygon(mask):
+
+    # [-2] works with both OpenCV 3 and 4 return values
+    contours = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if not len(contours):
+        return Polygon()
+
+    areas = [cv2.contourArea(c) for c in contours]
+    max_index = np.argmax(areas)
+    cnt = contours[max_index]
+    if len(cnt) < 3:
+        return Polygon()  # A point or a line, no area
+    rect = cv2.minAreaRect(cnt)
+    box = cv2.boxPoints(rect)
+    box = np.intp(box)
+
+    box = newbox(box)
+
+    # buffer(0) repairs possible self-intersections of the traced contour
+    maskpoly = Polygon(cnt[:, 0, :]).buffer(0)
+    rdpoly = Point(MID_POINT).buffer(MID_RADIUS, resolution=64).union(Polygon(box))
+
+    finalpoly = maskpoly.intersection(rdpoly)
+    if finalpoly.is_empty:
+        return Polygon()
+
+    # Keep the largest part, as the raster version's contour tracing would
+    if finalpoly.geom_type != "Polygon":
+        parts = [g for g in getattr(finalpoly, "geoms", []) if g.geom_type == "Polygon"]
+        finalpoly = max(parts, key=lambda g: g.area) if parts else Polygon()
+
+    return finalpoly
+
+
 def newbox(box):
     rate = 0.35
     keskp = (2048, 2048)
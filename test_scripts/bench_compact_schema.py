@@ -0,0 +1,84 @@
+## Benchmark: memory and filter latency of the defect database, original vs compact schema
+#  Synthetic database with the same columns as defect_db_v4.pkl. The timed operations
+#  are the ones DeftUI runs: statistics, show_filtered_files and the lookup in get_file_entry
+
+import os
+import sys
+import time
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.process_db import compact_defect_db
+from lib.db_index import FileRowIndex, FileSetIndex
+
+N_ROWS = 500000
+N_ORIGINS = 200
+N_FRAMES_PER_ORIGIN = 400
+TYPES = ["määramata", "pothole", "crack", "alligator crack", "patch", "rutting", "edge", "joint", "other"]
+N_REPEATS = 20
+
+rng = np.random.RandomState(42)
+
+
+def make_db():
+    origins = ["2019%04d_075700_LD5" % i for i in range(N_ORIGINS)]
+    o = rng.randint(0, N_ORIGINS, N_ROWS)
+    fr = rng.randint(0, N_FRAMES_PER_ORIGIN, N_ROWS)
+    fns = [origins[a] + "-%03d" % b for a, b in zip(o, fr)]
+    x = 540000 + fr * 15.0
+    y = 6580000 + o * 100.0
+    extents = [[a, a + 20.48, b, b + 20.48] for a, b in zip(x, y)]
+    geoms = [box(a + 5, b + 5, a + 6, b + 6) for a, b in zip(x, y)]
+    types = [TYPES[i] for i in rng.randint(0, len(TYPES), N_ROWS)]
+    return gpd.GeoDataFrame({"fn": fns, "extent": extents, "type": types,
+                             "origin": [origins[a] for a in o]}, geometry=geoms)
+
+
+# Memory of the attribute columns (the geometry column is the same in both schemas)
+def attr_memory(db):
+    return db.drop(columns="geometry").memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def timeit(fn):
+    t = time.time()
+    for _ in range(N_REPEATS):
+        fn()
+    return (time.time() - t) / N_REPEATS * 1000
+
+
+def stats_loop(db):
+    return {t: db[db["type"] == t].shape[0] for t in db["type"].unique().tolist()}
+
+
+def filter_files(db, origin, deft):
+    return db[np.logical_and.reduce([db["origin"] == origin, db["type"] == deft])]["fn"].unique().tolist()
+
+
+def file_lookup(db, fn):
+    return db[db["fn"] == fn]
+
+
+db = make_db()
+cdb = compact_defect_db(db)
+
+origin = db["origin"].iloc[0]
+fn = db["fn"].iloc[0]
+
+print("Rows:", N_ROWS)
+print("%-34s %12s %12s" % ("", "original", "compact"))
+print("%-34s %12.1f %12.1f" % ("attribute memory, MB", attr_memory(db), attr_memory(cdb)))
+print("%-34s %12.1f %12.1f" % ("statistics pass, ms", timeit(lambda: stats_loop(db)),
+                                timeit(lambda: stats_loop(cdb))))
+print("%-34s %12.1f %12.1f" % ("show_filtered_files filter, ms", timeit(lambda: filter_files(db, origin, "crack")),
+                                timeit(lambda: filter_files(cdb, origin, "crack"))))
+print("%-34s %12.1f %12.1f" % ("get_file_entry lookup, ms", timeit(lambda: file_lookup(db, fn)),
+                                timeit(lambda: file_lookup(cdb, fn))))
+
+index = FileRowIndex.from_db(cdb)
+print("%-34s %12s %12.3f" % ("get_file_entry, row index, ms", "-", timeit(lambda: index.rows(fn))))
+
+file_sets = FileSetIndex.from_db(cdb)
+print("%-34s %12s %12.3f" % ("show_filtered_files, inverted, ms", "-",
+                              timeit(lambda: file_sets.files({"origin": origin, "type": "crack"}))))
@@ -0,0 +1,60 @@
+## Benchmark: mask footprint contour backends
+#  Compares the skimage contour (the reference) with the OpenCV contour on a downsampled mask.
+#  Reports the time per mask and the polygon deviation (Hausdorff distance, pixels)
+#  If MASK_DIR is set, the .mask.png files from that folder are used, otherwise synthetic masks
+
+import os
+import time
+import numpy as np
+import cv2
+from shapely.geometry import Polygon
+
+from defect_db_build import get_mask_contour
+
+MASK_DIR = None  # e.g. r"C:\Data\_ReachU-defectTypes\201904_Origs\20190417_075700_LD5"
+N_MASKS = 20
+PYRAMID_LEVELS = [0, 1, 2, 3]
+
+rng = np.random.RandomState(42)
+
+
+# Synthetic orthoframe mask: the visible road area is a rotated band cut by a circle
+def make_mask(size=4096):
+    mask = np.zeros((size, size), np.uint8)
+    cv2.circle(mask, (size // 2, size // 2), int(size * rng.uniform(0.4, 0.5)), 255, -1)
+    band = np.zeros_like(mask)
+    rect = ((size / 2 + rng.uniform(-200, 200), size / 2), (size * 1.5, size * rng.uniform(0.5, 0.8)),
+            rng.uniform(-30, 30))
+    cv2.drawContours(band, [np.int32(cv2.boxPoints(rect))], 0, 255, -1)
+    return cv2.bitwise_and(mask, band)
+
+
+def load_masks():
+    if MASK_DIR is None:
+        return [make_mask() for _ in range(N_MASKS)]
+    fns = sorted([fn for fn in os.listdir(MASK_DIR) if fn.endswith(".mask.png")])[:N_MASKS]
+    return [cv2.imread(os.path.join(MASK_DIR, fn), cv2.IMREAD_GRAYSCALE) for fn in fns]
+
+
+def to_polygon(contour):
+    return Polygon(contour[:, ::-1])
+
+
+def run(masks, backend, pyramid_levels=None):
+    t = time.time()
+    contours = [get_mask_contour(m, backend=backend, pyramid_levels=pyramid_levels) for m in masks]
+    return (time.time() - t) / len(masks), contours
+
+
+masks = load_masks()
+print("Masks:", len(masks), "size:", masks[0].shape)
+
+t_ref, ref = run(masks, "skimage")
+print("%-16s %10s %8s %14s %14s" % ("backend", "ms/mask", "speedup", "max dev, px", "mean dev, px"))
+print("%-16s %10.1f %8s %14s %14s" % ("skimage", t_ref * 1000, "1.0x", "-", "-"))
+
+for levels in PYRAMID_LEVELS:
+    t_cv, res = run(masks, "opencv", levels)
+    devs = [to_polygon(a).hausdorff_distance(to_polygon(b)) for a, b in zip(ref, res)]
+    print("%-16s %10.1f %7.1fx %14.2f %14.2f" % ("opencv, level " + str(levels), t_cv * 1000,
+                                                   t_ref / t_cv, max(devs), np.mean(devs)))
@@ -0,0 +1,75 @@
+## Benchmark: overlay of frame footprints against one large shapefile,
+#  with and without the spatial index prefiltering of the shapefile
+#  Synthetic data: each folder is a drive along a road, the defects are spread over the whole country
+
+import time
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+
+from defect_db_build import overlay_defects
+
+# Number of folders, frames per folder and size of a frame (m)
+N_FOLDERS = 10
+N_FRAMES = 200
+FRAME_SIZE = 20.48
+
+# Shapefile sizes to try
+SHP_SIZES = [10000, 50000, 100000, 500000]
+
+# Area the defects are spread over (m)
+COUNTRY_SIZE = 300000
+
+CRS = "EPSG:3301"
+
+rng = np.random.RandomState(42)
+
+
+# Frames of one folder: a straight drive with overlapping frames
+def make_folder(k):
+    x0, y0 = rng.uniform(0, COUNTRY_SIZE, 2)
+    geoms = [box(x0 + i * FRAME_SIZE / 2, y0, x0 + i * FRAME_SIZE / 2 + FRAME_SIZE, y0 + FRAME_SIZE)
+             for i in range(N_FRAMES)]
+    return gpd.GeoDataFrame({"fn": [str(k) + "-" + str(i) for i in range(N_FRAMES)]}, geometry=geoms, crs=CRS)
+
+
+# Random small defects all over the country, plus some on each drive
+def make_shapefile(n, folders):
+    xy = rng.uniform(0, COUNTRY_SIZE, (n, 2))
+    geoms = [box(x, y, x + 0.5, y + 0.5) for x, y in xy]
+    for f in folders:
+        xmin, ymin, xmax, ymax = f.total_bounds
+        for x, y in zip(rng.uniform(xmin, xmax, 100), rng.uniform(ymin, ymax, 100)):
+            geoms.append(box(x, y, x + 0.5, y + 0.5))
+    return gpd.GeoDataFrame({"type": ["pothole"] * len(geoms)}, geometry=geoms, crs=CRS)
+
+
+def run(folders, shp, prefilter):
+    t = time.time()
+    rows = 0
+    for f in folders:
+        rows += len(overlay_defects(f, shp, prefilter=prefilter))
+    return time.time() - t, rows
+
+
+folders = [make_folder(k) for k in range(N_FOLDERS)]
+
+print("Folders:", N_FOLDERS, "frames per folder:", N_FRAMES)
+print("%10s %12s %12s %8s %s" % ("defects", "overlay, s", "prefilt, s", "speedup", "rows"))
+
+for n in SHP_SIZES:
+    shp = make_shapefile(n, folders)
+
+    # Building the index of the shapefile happens once, it is reused by all folders
+    t = time.time()
+    shp.sindex
+    t_index = time.time() - t
+
+    t_full, rows_full = run(folders, shp, prefilter=False)
+    t_pre, rows_pre = run(folders, shp, prefilter=True)
+    t_pre += t_index
+
+    if rows_full != rows_pre:
+        raise ValueError("Prefiltering changed the result")
+
+    print("%10d %12.2f %12.2f %7.1fx %d" % (len(shp), t_full, t_pre, t_full / t_pre, rows_pre))
@@ -0,0 +1,78 @@
+## Benchmark: spatial queries over the defect database
+#  Builds the spatial index (lib/spatial_query.py) over a synthetic database of N_DEFECTS defects
+#  and reports the build time, the open time and the latency of every kind of query,
+#  compared with filtering the full GeoDataFrame by hand
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.spatial_query import build_spatial_index, SpatialIndex
+
+N_DEFECTS = 2000000
+N_ORIGINS = 500
+N_FRAMES_PER_ORIGIN = 400
+FRAME_SIZE = 20.48
+N_QUERIES = 200
+QUERY_SIZE = 50.0  # Side of the query box and diameter of the radius query, m
+N_NAIVE_QUERIES = 3
+
+rng = np.random.RandomState(42)
+
+
+# Frames follow the roads (one road per origin), defects are small boxes inside the frames
+def make_db():
+    o = rng.randint(0, N_ORIGINS, N_DEFECTS)
+    fr = rng.randint(0, N_FRAMES_PER_ORIGIN, N_DEFECTS)
+    fns = ["%04d-%03d" % (a, b) for a, b in zip(o, fr)]
+    x0 = 540000 + fr * 15.0
+    y0 = 6580000 + o * 100.0
+    dx, dy = rng.uniform(0, FRAME_SIZE - 2, N_DEFECTS), rng.uniform(0, FRAME_SIZE - 2, N_DEFECTS)
+    w, h = rng.uniform(0.1, 2, N_DEFECTS), rng.uniform(0.1, 2, N_DEFECTS)
+    geoms = [box(a + c, b + d, a + c + e, b + d + f) for a, b, c, d, e, f in zip(x0, y0, dx, dy, w, h)]
+    return gpd.GeoDataFrame({"fn": fns, "type": "crack", "origin": ["%04d" % a for a in o],
+                             "xmin": x0, "xmax": x0 + FRAME_SIZE, "ymin": y0, "ymax": y0 + FRAME_SIZE},
+                            geometry=geoms)
+
+
+def timeit(fn, args_list):
+    t = time.time()
+    for args in args_list:
+        fn(*args)
+    return (time.time() - t) / len(args_list) * 1000
+
+
+print("Generating", N_DEFECTS, "defects...")
+db = make_db()
+index_dir = tempfile.mkdtemp()
+
+t = time.time()
+build_spatial_index(db, index_dir)
+print("Build: %.1f s" % (time.time() - t))
+
+t = time.time()
+sidx = SpatialIndex(index_dir)
+print("Open: %.1f ms" % ((time.time() - t) * 1000))
+
+xs = rng.uniform(540000, 540000 + N_FRAMES_PER_ORIGIN * 15.0, N_QUERIES)
+ys = rng.uniform(6580000, 6580000 + N_ORIGINS * 100.0, N_QUERIES)
+boxes = [(x, y, x + QUERY_SIZE, y + QUERY_SIZE) for x, y in zip(xs, ys)]
+polys = [(box(*b).buffer(QUERY_SIZE / 4),) for b in boxes]
+
+print("Mean defects per bbox query: %.1f" % np.mean([len(sidx.query_bbox(*b)[0]) for b in boxes]))
+print("%-24s %12s" % ("query", "ms/query"))
+print("%-24s %12.2f" % ("bbox", timeit(sidx.query_bbox, boxes)))
+print("%-24s %12.2f" % ("polygon", timeit(sidx.query_polygon, polys)))
+print("%-24s %12.2f" % ("point-radius", timeit(sidx.query_radius, [(x, y, QUERY_SIZE / 2) for x, y in zip(xs, ys)])))
+print("%-24s %12.2f" % ("k-nearest, k=10", timeit(sidx.query_nearest, [(x, y, 10) for x, y in zip(xs, ys)])))
+print("%-24s %12.2f" % ("frames, polygon", timeit(sidx.query_frames, polys)))
+print("%-24s %12.2f" % ("full table, bbox", timeit(lambda *b: db[db.intersects(box(*b))], boxes[:N_NAIVE_QUERIES])))
+
+sidx.close()
+shutil.rmtree(index_dir)
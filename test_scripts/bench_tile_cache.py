@@ -0,0 +1,91 @@
+## Benchmark: random crop latency from the orthoframes
+#  Writes N_FRAMES synthetic FRAME_PX x FRAME_PX JPEG frames and their tile caches (lib/tile_cache.py)
+#  and reports the latency of a random defect crop as a full JPEG decode + crop, a windowed
+#  read (rasterio) and a tile cache read, and of the left panel overview as a reduced JPEG
+#  decode and a tile cache pyramid level
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import cv2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.tile_cache import convert_raster, tile_cache_file, TilePyramid
+from lib.process_img import read_rgb, read_window_rgb, OVERVIEW_IMREAD_FLAGS
+
+N_FRAMES = 8
+FRAME_PX = 4096
+N_CROPS = 200
+CROP_PX = (50, 400)  # Range of the crop side, px
+OVERVIEW_SCALE = 4
+
+rng = np.random.RandomState(42)
+
+
+# Smooth noise, compresses roughly like a road surface
+def make_frame():
+    small = rng.randint(0, 255, (FRAME_PX // 16, FRAME_PX // 16, 3)).astype(np.uint8)
+    img = cv2.resize(small, (FRAME_PX, FRAME_PX), interpolation=cv2.INTER_CUBIC)
+    return np.clip(img.astype(np.int16) + rng.randint(-8, 8, img.shape), 0, 255).astype(np.uint8)
+
+
+def random_crops():
+    crops = []
+    for _ in range(N_CROPS):
+        w, h = rng.randint(*CROP_PX, size=2)
+        x, y = rng.randint(0, FRAME_PX - w), rng.randint(0, FRAME_PX - h)
+        crops.append((rng.randint(0, N_FRAMES), x, x + w, y, y + h))
+    return crops
+
+
+def bench(name, fn, args_list):
+    t = time.time()
+    for args in args_list:
+        fn(*args)
+    print("%-28s %8.2f ms" % (name, (time.time() - t) / len(args_list) * 1000))
+
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    print("Writing", N_FRAMES, "frames...")
+    frames = []
+    for i in range(N_FRAMES):
+        fn = os.path.join(tmp_dir, "frame%02d.jpg" % i)
+        cv2.imwrite(fn, make_frame(), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        frames.append(fn)
+
+    t = time.time()
+    for fn in frames:
+        convert_raster(fn)
+    print("Tile cache conversion: %.0f ms per frame" % ((time.time() - t) / N_FRAMES * 1000))
+    print("JPEG size: %.1f MB per frame, tile cache: %.1f MB per frame" %
+          (os.path.getsize(frames[0]) / 1e6, os.path.getsize(tile_cache_file(frames[0])) / 1e6))
+
+    crops = random_crops()
+    pyramids = [TilePyramid(tile_cache_file(fn)) for fn in frames]
+
+    print("Random crop, %d crops:" % N_CROPS)
+    bench("full decode + crop", lambda i, x1, x2, y1, y2: read_rgb(frames[i])[y1:y2, x1:x2], crops[:20])
+    try:
+        import rasterio
+        warnings.simplefilter("ignore", rasterio.errors.NotGeoreferencedWarning)
+        bench("windowed read (rasterio)",
+              lambda i, x1, x2, y1, y2: read_window_rgb(frames[i], x1, x2, y1, y2), crops)
+    except ImportError:
+        print("windowed read (rasterio)     not installed")
+    bench("tile cache", lambda i, x1, x2, y1, y2: pyramids[i].read_window(x1, x2, y1, y2), crops)
+
+    level = pyramids[0].level_of_scale(OVERVIEW_SCALE)
+    print("Overview (1/%d):" % OVERVIEW_SCALE)
+    bench("reduced JPEG decode", lambda fn: read_rgb(fn, OVERVIEW_IMREAD_FLAGS[OVERVIEW_SCALE]),
+          [(fn,) for fn in frames])
+    bench("tile cache level %d" % level, lambda p: p.read_level(level), [(p,) for p in pyramids])
+    bench("tile cache open + level %d" % level,
+          lambda fn: TilePyramid(tile_cache_file(fn)).read_level(level), [(fn,) for fn in frames])
+
+finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,26 @@
+## Convert the orthoframes to tiled pyramid caches (lib/tile_cache.py)
+#  Every <frame>.jpg in the subfolders of the origin folders gets a <frame>.tiles next to it.
+#  Frames whose cache is newer than the JPEG are skipped, so the script can be rerun after new data
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.tile_cache import convert_folder
+
+ORTHO_ROOTS = [r"C:\Data\_ReachU-defectTypes\201904_Origs",
+               r"C:\Data\_ReachU-defectTypes\__new_2020_06\origin_folders"]
+WORKERS = None  # Number of processes, None = number of CPUs
+
+if __name__ == "__main__":
+    for root in ORTHO_ROOTS:
+        for origin in sorted(os.listdir(root)):
+            path = os.path.join(root, origin)
+            if not os.path.isdir(path):
+                continue
+            t = time.time()
+            n = convert_folder(path, workers=WORKERS)
+            print(origin + ":", n, "frames converted in %.1f s" % (time.time() - t))
+
+    print("Done.")
@@ -0,0 +1,17 @@
+## Convert a pickled defect database (defect_db_v4.pkl etc.) to the columnar format
+#  The result is written next to the pickle as <db name>_columnar/defect_db.coldb
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.columnar_db import convert_pickle_db
+
+DB_FILES = [r"C:\Data\_ReachU-defectTypes\201904_Origs\defect_db_v4.pkl",
+            r"C:\Data\_ReachU-defectTypes\__new_2020_06\origin_folders\NEWdefect_db_v4.pkl"]
+
+for db_file in DB_FILES:
+    print("Converting", db_file, "...")
+    convert_pickle_db(db_file, os.path.splitext(db_file)[0] + "_columnar")
+
+print("Done.")
@@ -2,233 +2,190 @@
 #  Here we use set operations with overlay from geopandas
 
 import os
-import rasterio
 import geopandas as gpd
-import pandas as pd
-from shapely.geometry import Polygon
 import pickle
-import cv2
-from tqdm import tqdm
-from skimage.measure import find_contours, approximate_polygon
 
-from annotmask import get_sqround_mask
+from defect_db_build import shpf_name, get_paths_to_process, build_defect_db, build_defect_db_parallel
+from defect_db_manifest import manifest_file, load_manifest, save_manifest, update_defect_db, update_partitioned_db
+from lib.db_partitions import PartitionedDbWriter, read_partitioned_db  # lib is on the path via defect_db_build
+from lib.process_db import compact_defect_db, expand_defect_db, compute_db_stats
+from lib.columnar_db import write_columnar_db
+from lib.sqlite_db import write_sqlite_db
+from lib.spatial_query import build_spatial_index
+from lib.defect_clusters import add_defect_ids
 
 # In this version, narrower masks are used to check defect inclusion
 
-# For simplification of polygons
-POLY_APPROX_TOLERANCE = 5
 DEFECT_DB_FILE = "defect_db_v4.pkl"
 
 # Make a narrower mask
 NARROW_MASK = True
 
-# This script is used to build a database of ALL defect types found on a particular road segment
-# It should be run on a particular machine that shall handle the task of defect type preprocessing for ML
-# because it stores absolute paths necessary to access the image files for the task
-dt_dirs_root = r"C:\Data\_ReachU-defectTypes\202004_Defect_types"  # Root dir that contains the folders with shapefiles
-im_dirs_root = r"C:\Data\_ReachU-defectTypes\201904_Origs"  # Root dir with image folders
-
-# Shapefile naming convention
-shpf_name = "defects_categorized.shp"
+# Process the folders (and the frames inside large folders) in a process pool.
+# The result is identical to the serial build
+PARALLEL_BUILD = True
+BUILD_WORKERS = None  # None means all CPU cores
 
-# Undefined label
-lbl_undefined = "määramata"  # Estonian for undefined
+# Keep a manifest of the input files next to the database and only reprocess
+# the folders and frames that changed since the previous run
+INCREMENTAL_BUILD = True
 
+# Instead, stream every folder into a partition directory next to the database as soon as
+# it is done. A new build (also an interrupted one) reuses the partitions whose inputs and
+# build parameters have not changed, the manifest of each is stored with the partition
+PARTITIONED_BUILD = False
 
-# Needed to create a mask shape
-def transform_to_geo_coordinates(extent, xy):
+# Save the database in the compact schema: categorical fn/type/origin and
+# the extent split into xmin/xmax/ymin/ymax columns. The viewer reads both schemas
+COMPACT_SCHEMA = True
 
-    # Get data from tuple
-    x, y = xy
-    xmin, xmax, ymin, ymax = extent
-    h, w = 4096, 4096
+# Group the rows of the same physical defect found on overlapping frames and give every
+# group a stable ID (defect_id column). Rows of different frames are grouped when they
+# overlap by at least CLUSTER_MIN_OVERLAP of the smaller one and have the same type
+CLUSTER_DUPLICATES = True
+CLUSTER_MIN_OVERLAP = 0.5
 
-    gx = xmin + (xmax - xmin) * (x / w)
-    gy = ymin + (ymax - ymin) * (1 - y / h)
+# Also write the database in the columnar format the viewer reads column by column
+# (<db name>_columnar/defect_db.coldb). The pickle is still needed for incremental builds
+COLUMNAR_OUTPUT = True
 
-    return gx, gy
+# Also write the database as a single SQLite file (<db name>.sqlite) with an R-tree over the
+# defect bounding boxes. The viewer queries it on demand instead of loading the whole database
+SQLITE_OUTPUT = False
 
+# Also build the spatial index (<db name>_spatial) for bbox, polygon, radius and nearest queries
+SPATIAL_INDEX_OUTPUT = True
 
-# Send in the mask here.
-def get_mask_shape_polygon(mask, extent, want_narrow=False):
-
-    # Should the mask become narrower?
-    if want_narrow:
-        mask = get_sqround_mask(mask)
-
-    # Find the contours
-    contours = find_contours(mask, 1)
-    contour = contours[0]  # We know there's only ONE contour
-    contour = approximate_polygon(contour, tolerance=POLY_APPROX_TOLERANCE)
-
-    # Construct the <polygon> shape
-    poly_points_x = []
-    poly_points_y = []
-    for r in contour:
-        gx, gy = transform_to_geo_coordinates(extent, (r[1], r[0]))
-        poly_points_x.append(gx)
-        poly_points_y.append(gy)
+# This script is used to build a database of ALL defect types found on a particular road segment
+# It should be run on a particular machine that shall handle the task of defect type preprocessing for ML
+# because it stores absolute paths necessary to access the image files for the task
+dt_dirs_root = r"C:\Data\_ReachU-defectTypes\202004_Defect_types"  # Root dir that contains the folders with shapefiles
+im_dirs_root = r"C:\Data\_ReachU-defectTypes\201904_Origs"  # Root dir with image folders
 
-    polygon_geom = Polygon(zip(poly_points_x, poly_points_y))
-    polygon = gpd.GeoDataFrame(index=[0], crs={'init': 'espg:3301'}, geometry=[polygon_geom])
 
-    return polygon_geom, polygon
+# Build the database that is stored in db_file. Either shp_files (folder key -> shapefile)
+# or shp_file (one shapefile for all folders) is given
+def run_build(db_file, ortho_dirs, shp_files=None, shp_file=None):
 
-# For counting values (remember, dict is passed by ref)
-def inc_dict(d, key, val=1):
-    if key in d:
-        d[key] += 1
-    else:
-        d[key] = val
+    workers = BUILD_WORKERS if PARALLEL_BUILD else 1
 
+    if PARTITIONED_BUILD:
 
-# Process a folder with VRT files - create a GeoPandas dataframe
-# with relevant information about file and the mask shape
-# Returns a dataframe with this information
-def process_vrt_folder(path, want_narrow=False):
+        parts_dir = os.path.splitext(db_file)[0] + "_parts"
+        update_partitioned_db(PartitionedDbWriter(parts_dir), ortho_dirs, shp_files=shp_files,
+                              shp_file=shp_file, want_narrow=NARROW_MASK, workers=workers)
 
-    path = path.replace("\\", "/")  # Standard sanitizing
-    if not path.endswith("/"):
-        path += "/"
+        # The final database and the duplicate clustering need all the rows at once;
+        # the partitions are compacted while they are read to keep that as small as possible
+        full_defect_db = read_partitioned_db(parts_dir, origins=list(ortho_dirs), compact=COMPACT_SCHEMA)
+        manifest = None
 
-    print("Creating shapes for masks...")
+    elif INCREMENTAL_BUILD:
 
-    vrts = os.listdir(path)
-    vrts = [vrt for vrt in vrts if vrt.endswith(".vrt")]  # Only VRT files
+        # Start from the previous database, if there is one
+        db = None
+        manifest = load_manifest(db_file)
+        if manifest is not None and os.path.isfile(db_file):
+            with open(db_file, "rb") as f:
+                db = expand_defect_db(pickle.load(f)["defect_db"])
 
-    ortho_data_cols = ['fn', 'extent']
-    ortho_data = []
-    ortho_shapes = []
+        full_defect_db, manifest = update_defect_db(db, manifest, ortho_dirs, shp_files=shp_files,
+                                                    shp_file=shp_file, want_narrow=NARROW_MASK,
+                                                    workers=workers)
 
-    for f in tqdm(vrts):
+    elif PARALLEL_BUILD:
+        full_defect_db = build_defect_db_parallel(ortho_dirs, shp_files=shp_files, shp_file=shp_file,
+                                                  want_narrow=NARROW_MASK, workers=workers)
+        manifest = None
 
-        f_ind = f.replace(".vrt", "")
+    else:
+        shp = gpd.read_file(shp_file) if shp_file is not None else None
+        full_defect_db = build_defect_db(ortho_dirs, shp_files=shp_files, shp=shp, want_narrow=NARROW_MASK)
+        manifest = None
 
-        # Find ortho bounds
-        rvrt = rasterio.open(os.path.join(path, f))
-        rbnd = rvrt.bounds
-        bl, bb, br, bt = rbnd.left, rbnd.bottom, rbnd.right, rbnd.top
-        extent = [bl, br, bb, bt]  # Extent of image
+    if CLUSTER_DUPLICATES:
+        full_defect_db = add_defect_ids(full_defect_db, min_overlap=CLUSTER_MIN_OVERLAP)
 
-        # Get the mask
-        mask = cv2.imread(os.path.join(path, f_ind + ".mask.png"), cv2.IMREAD_GRAYSCALE)
+    if COMPACT_SCHEMA:
+        full_defect_db = compact_defect_db(full_defect_db)
 
-        maskpoly, _ = get_mask_shape_polygon(mask, extent, want_narrow=want_narrow)
-        rvrt.close()
+    return full_defect_db, manifest
 
-        # Append info
-        ortho_data.append([f_ind, extent])
-        ortho_shapes.append(maskpoly)
 
-    df = pd.DataFrame(data=ortho_data, columns=ortho_data_cols)
+# Save the database and the manifest describing its inputs.
+# The statistics the viewer shows at startup are computed here once and stored with the database
+def save_db(db_file, datas, manifest):
 
-    # Once all over, create and return the dataframe
-    return gpd.GeoDataFrame(df, crs={'init': 'espg:3301'}, geometry=ortho_shapes)
+    datas["stats"] = compute_db_stats(datas["defect_db"])
 
+    # The old manifest is removed first and the new one written last:
+    # if the database write fails, the next run starts over
+    if os.path.isfile(manifest_file(db_file)):
+        os.remove(manifest_file(db_file))
 
-# Join N geopandas dataframes
-def join_gdf(gdf_list, ignore_index=True):
-    if not gdf_list:
-        # Return empty geodataframe
-        return gpd.GeoDataFrame()
+    with open(db_file, "wb") as f:
+        pickle.dump(datas, f)
 
-    # Take the CRS from the first entry and check all others
-    crs = gdf_list[0].crs
+    meta = {k: v for k, v in datas.items() if k not in ("defect_db", "stats")}
 
-    # Check all the merged dataframes so that the CRS is exactly the same everywhere
-    for gdf in gdf_list:
-        if gdf.crs != crs:
-            raise ValueError("Cannot join GeoDataFrames with different CRS")
+    if COLUMNAR_OUTPUT:
+        write_columnar_db(datas["defect_db"], os.path.splitext(db_file)[0] + "_columnar", meta=meta,
+                          stats=datas["stats"])
 
-    # Finally, join the geodataframes resetting the index
-    return gpd.GeoDataFrame(pd.concat(gdf_list, ignore_index=ignore_index), crs=crs)
+    if SQLITE_OUTPUT:
+        write_sqlite_db(datas["defect_db"], os.path.splitext(db_file)[0] + ".sqlite", meta=meta,
+                        stats=datas["stats"])
 
+    if SPATIAL_INDEX_OUTPUT:
+        build_spatial_index(datas["defect_db"], os.path.splitext(db_file)[0] + "_spatial")
 
-# Get list of top level dirs to process, absolute paths with os.sep converted
-# to / since python understands it even in windows
-def get_paths_to_process(base_path, add_file=None):
-    base_path = base_path.replace("\\", "/")
-    base_path = base_path[:-1] if base_path.endswith("/") else base_path  # Typical sanitization
-    dirs = next(os.walk(base_path))[1]
-    return {d: base_path + "/" + d + (("/" + add_file) if add_file else "") for d in dirs}
+    if manifest is not None:
+        save_manifest(db_file, manifest)
 
 
 # %% Initial database
+def build_initial_db():
 
-# Define the paths to process
-ortho_dir = r"C:\Data\_ReachU-defectTypes\201904_Origs"
-shp_dir = r"C:\Data\_ReachU-defectTypes\202004_Defect_types"
-
-ortho_dirs = get_paths_to_process(ortho_dir)
-shp_dirs = get_paths_to_process(shp_dir, shpf_name)
+    # Define the paths to process
+    ortho_dir = r"C:\Data\_ReachU-defectTypes\201904_Origs"
+    shp_dir = r"C:\Data\_ReachU-defectTypes\202004_Defect_types"
 
-# Check that all keys are there
-if set(ortho_dirs.keys()) != set(shp_dirs.keys()):
-    raise KeyError("Error in matching ortho/shapefile folders.")
+    ortho_dirs = get_paths_to_process(ortho_dir)
+    shp_dirs = get_paths_to_process(shp_dir, shpf_name)
 
-# Go through all folders and create the relevant GeoDataFrames
-gdf_list = []
-for k in ortho_dirs:
-    orthoshapes = process_vrt_folder(ortho_dirs[k], want_narrow=True)
-    shp = gpd.read_file(shp_dirs[k])
+    # Check that all keys are there
+    if set(ortho_dirs.keys()) != set(shp_dirs.keys()):
+        raise KeyError("Error in matching ortho/shapefile folders.")
 
-    # explode() at the end explodes multipolygons to polygons while duplicating entries
-    # replace() replaces Type=None with "määramata"
-    ovrl = gpd.overlay(orthoshapes, shp, how='intersection').explode()
-    ovrl.replace(to_replace=[None], value=lbl_undefined, inplace=True)
+    # Go through all folders and create the relevant GeoDataFrames, then put it all together
+    db_file = os.path.join(ortho_dir, DEFECT_DB_FILE)
+    full_defect_db, manifest = run_build(db_file, ortho_dirs, shp_files=shp_dirs)
 
-    gdf_list.append(ovrl)
+    # Save the database
+    datas = {"shapefile_dirs_root": shp_dir, "image_dirs_root": ortho_dir, "defect_db": full_defect_db}
+    save_db(db_file, datas, manifest)
 
-# Finally, put it all together
-full_defect_db = join_gdf(gdf_list)
-
-# Add the origin column
-origins = []
-for i, k in full_defect_db.iterrows():
-    origins.append(k["fn"].split("-")[0])
-
-# Add the column
-full_defect_db["origin"] = origins
-
-# Save the database
-datas = {"shapefile_dirs_root": shp_dir, "image_dirs_root": ortho_dir, "defect_db": full_defect_db}
-with open(os.path.join(ortho_dir, DEFECT_DB_FILE), "wb") as f:
-    pickle.dump(datas, f)
 
 ################################################
 # %% Second database (later both will be merged)
-ortho_dir = r"C:\Data\_ReachU-defectTypes\__new_2020_06\origin_folders"
-
-# One shapefile for all... intersection will take a bit of time methinks
-shp_file_loc = r"C:\Data\_ReachU-defectTypes\__new_2020_06\AI_defect_types" + os.sep + shpf_name
-
-# Let's get going
-shp = gpd.read_file(shp_file_loc)
-gdf_list = []
+def build_new_db():
 
-ortho_dirs = get_paths_to_process(ortho_dir)
+    ortho_dir = r"C:\Data\_ReachU-defectTypes\__new_2020_06\origin_folders"
 
-dir_cnt = 1
-dir_total = len(ortho_dirs)
+    # One shapefile for all... intersection will take a bit of time methinks
+    shp_file_loc = r"C:\Data\_ReachU-defectTypes\__new_2020_06\AI_defect_types" + os.sep + shpf_name
 
-for k in ortho_dirs:
-    print("Processing folder", dir_cnt, "of", dir_total)
-    orthoshapes = process_vrt_folder(ortho_dirs[k], want_narrow=True)
-    ovrl = gpd.overlay(orthoshapes, shp, how='intersection').explode()
-    ovrl.replace(to_replace=[None], value=lbl_undefined, inplace=True)
-    gdf_list.append(ovrl)
-    dir_cnt += 1
+    ortho_dirs = get_paths_to_process(ortho_dir)
 
-full_defect_db = join_gdf(gdf_list)
+    # Let's get going
+    db_file = os.path.join(ortho_dir, "NEW" + DEFECT_DB_FILE)
+    full_defect_db, manifest = run_build(db_file, ortho_dirs, shp_file=shp_file_loc)
 
-# Add the origin column
-origins = []
-for i, k in full_defect_db.iterrows():
-    origins.append(k["fn"].split("-")[0])
+    datas = {"shapefile_dirs_root": "", "image_dirs_root": ortho_dir, "defect_db": full_defect_db}
+    save_db(db_file, datas, manifest)
 
-# Add the column
-full_defect_db["origin"] = origins
 
-datas = {"shapefile_dirs_root": "", "image_dirs_root": ortho_dir, "defect_db": full_defect_db}
-with open(os.path.join(ortho_dir, "NEW" + DEFECT_DB_FILE), "wb") as f:
-    pickle.dump(datas, f)
\ No newline at end of file
+# The worker processes import this script again on Windows, so the build must only run from here
+if __name__ == "__main__":
+    build_initial_db()
+    build_new_db()
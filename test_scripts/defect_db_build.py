@@ -0,0 +1,452 @@
+## Building blocks for the defect database (v4 and later)
+#  Moved out of create_defect_db_v4.py so that the functions can be imported
+#  by worker processes without re-running the whole build script
+
+import os
+import sys
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import Polygon
+import cv2
+from tqdm import tqdm
+from skimage.measure import find_contours, approximate_polygon
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from annotmask import get_sqround_mask, get_sqround_polygon
+
+# The repository libraries
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.geo_transform import geotransform_from_extent, extent_from_geotransform, pixel_to_geo
+from lib.vrt_footprints import scan_vrt_folder
+from lib.process_db import join_gdf
+from lib.polygon_cache import PolygonCache, hash_file, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+
+# For simplification of polygons
+POLY_APPROX_TOLERANCE = 5
+
+# Shapefile naming convention
+shpf_name = "defects_categorized.shp"
+
+# Undefined label
+lbl_undefined = "määramata"  # Estonian for undefined
+
+# Narrow the shapefile down to the defects near the frames with a spatial index before the overlay
+PREFILTER_DEFECTS = True
+
+# Contour backend for the mask footprints: "skimage" traces the full resolution mask with
+# sub-pixel accuracy, "opencv" traces a pyramid-downsampled mask with cv2.findContours and
+# scales the result back, which is a lot faster (see bench_contour_backend.py)
+CONTOUR_BACKEND = "skimage"
+CONTOUR_PYRAMID_LEVELS = 1  # Each level halves the mask size
+
+# How the narrower mask is computed: "raster" draws the circle and the shrunken box into a
+# full-size raster and ANDs it with the mask, "vector" intersects the mask polygon with them
+# using shapely, which needs far less memory and time. The results agree within the tolerance
+NARROW_MASK_MODE = "raster"
+
+# Cache the mask footprint contours on disk, since the masks almost never change
+USE_MASK_POLYGON_CACHE = True
+MASK_POLYGON_CACHE_DIR = DEFAULT_CACHE_DIR
+MASK_POLYGON_CACHE_MAX_BYTES = DEFAULT_MAX_BYTES
+
+# Large folders are split into chunks of this many frames for the process pool
+FRAMES_PER_TASK = 250
+
+
+# Simplified contour of the mask with skimage
+def _mask_contour_skimage(mask):
+
+    # Find the contours
+    contours = find_contours(mask, 1)
+    if not contours:
+        return np.zeros((0, 2))
+    contour = contours[0]  # We know there's only ONE contour
+    return approximate_polygon(contour, tolerance=POLY_APPROX_TOLERANCE)
+
+
+# Simplified contour of the mask with OpenCV on a downsampled mask
+def _mask_contour_opencv(mask, pyramid_levels):
+
+    small = mask
+    for _ in range(pyramid_levels):
+        small = cv2.pyrDown(small)
+    _, small = cv2.threshold(small, 127, 255, cv2.THRESH_BINARY)
+
+    sy = mask.shape[0] / small.shape[0]
+    sx = mask.shape[1] / small.shape[1]
+
+    # The largest outer contour, simplified with the tolerance scaled to the small mask
+    # ([-2] works with both OpenCV 3 and 4 return values)
+    contours = cv2.findContours(small, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if not len(contours):
+        return np.zeros((0, 2))
+    cnt = max(contours, key=cv2.contourArea)
+    cnt = cv2.approxPolyDP(cnt, POLY_APPROX_TOLERANCE / max(sx, sy), True)[:, 0, :].astype(np.float64)
+
+    # Back to full resolution (row, col), closed like the skimage contour.
+    # pyrDown centers pixel i of the smaller level on pixel 2i of the larger one
+    contour = np.column_stack((cnt[:, 1] * sy, cnt[:, 0] * sx))
+    return np.vstack((contour, contour[:1]))
+
+
+# Parameters of the contour extraction that change its result, for the cache keys and the
+# manifest: the backend (the pyramid levels only matter for opencv), or "vector" if the vector
+# narrowing produces the polygon without tracing a contour
+def contour_params(want_narrow=False, backend=None, pyramid_levels=None):
+    if want_narrow and NARROW_MASK_MODE == "vector":
+        return ("vector",)
+    backend = CONTOUR_BACKEND if backend is None else backend
+    if backend == "opencv":
+        return backend, CONTOUR_PYRAMID_LEVELS if pyramid_levels is None else pyramid_levels
+    return (backend,)
+
+
+# Simplified contour of the mask in pixel coordinates (row, col), empty if the mask is empty
+def get_mask_contour(mask, want_narrow=False, backend=None, pyramid_levels=None):
+
+    backend = CONTOUR_BACKEND if backend is None else backend
+    pyramid_levels = CONTOUR_PYRAMID_LEVELS if pyramid_levels is None else pyramid_levels
+
+    # The vector narrowing produces the polygon directly, no contour tracing needed
+    if want_narrow and NARROW_MASK_MODE == "vector":
+        poly = get_sqround_polygon(mask).simplify(POLY_APPROX_TOLERANCE)
+        if poly.is_empty:
+            return np.zeros((0, 2))
+        return np.asarray(poly.exterior.coords)[:, ::-1]  # (x, y) -> (row, col)
+
+    # Should the mask become narrower?
+    if want_narrow:
+        mask = get_sqround_mask(mask)
+
+    if backend == "skimage":
+        return _mask_contour_skimage(mask)
+    elif backend == "opencv":
+        return _mask_contour_opencv(mask, pyramid_levels)
+    else:
+        raise ValueError("Unknown contour backend: " + str(backend))
+
+
+# Construct the <polygon> shape from the pixel contour
+def contour_to_polygon(contour, geotransform):
+
+    # Contour points are (row, col)
+    poly_points_x, poly_points_y = pixel_to_geo(geotransform, contour[:, 1], contour[:, 0])
+
+    return Polygon(np.column_stack((poly_points_x, poly_points_y)))
+
+
+# Send in the mask here. The geotransform of the raster should be given;
+# if it is not, it is derived from the extent and the actual mask size
+def get_mask_shape_polygon(mask, extent, want_narrow=False, geotransform=None):
+
+    if geotransform is None:
+        geotransform = geotransform_from_extent(extent, mask.shape[1], mask.shape[0])
+
+    polygon_geom = contour_to_polygon(get_mask_contour(mask, want_narrow), geotransform)
+    polygon = gpd.GeoDataFrame(index=[0], crs={'init': 'espg:3301'}, geometry=[polygon_geom])
+
+    return polygon_geom, polygon
+
+
+# The mask contour cache of this process
+_mask_polygon_cache = None
+
+
+def get_mask_polygon_cache():
+    global _mask_polygon_cache
+    if _mask_polygon_cache is None:
+        _mask_polygon_cache = PolygonCache(MASK_POLYGON_CACHE_DIR, MASK_POLYGON_CACHE_MAX_BYTES)
+    return _mask_polygon_cache
+
+
+# Read the mask file and get its simplified contour, going through the cache if it is enabled.
+# mask_hash is the content hash of the mask file if already known (from the manifest)
+def load_mask_contour(mask_file, want_narrow=False, backend=None, pyramid_levels=None, mask_hash=None):
+
+    if not USE_MASK_POLYGON_CACHE:
+        return get_mask_contour(cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE), want_narrow, backend, pyramid_levels)
+
+    cache = get_mask_polygon_cache()
+    mask_hash = hash_file(mask_file) if mask_hash is None else mask_hash
+    key = cache.make_key(mask_hash, want_narrow, POLY_APPROX_TOLERANCE, *contour_params(want_narrow, backend, pyramid_levels))
+
+    contour = cache.get(key)
+    if contour is None:
+        contour = get_mask_contour(cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE), want_narrow, backend, pyramid_levels)
+        cache.put(key, contour)
+
+    return contour
+
+
+# For counting values (remember, dict is passed by ref)
+def inc_dict(d, key, val=1):
+    if key in d:
+        d[key] += 1
+    else:
+        d[key] = val
+
+
+# Standard sanitizing of a folder path
+def sanitize_dir(path):
+    path = path.replace("\\", "/")
+    if not path.endswith("/"):
+        path += "/"
+    return path
+
+
+# List the VRT files in a folder (sorted, so that every run sees the same order)
+def list_vrts(path):
+    vrts = os.listdir(path)
+    return sorted([vrt for vrt in vrts if vrt.endswith(".vrt")])  # Only VRT files
+
+
+# Process a given list of VRT files from a folder - create a GeoPandas dataframe
+# with relevant information about file and the mask shape.
+# The VRT metadata comes from the footprint catalog of the folder.
+# mask_hashes (frame -> content hash of its mask) saves hashing the masks again if known
+def process_vrt_frames(path, vrts, want_narrow=False, progress=True, update_catalog=True, mask_hashes=None):
+
+    mask_hashes = mask_hashes if mask_hashes is not None else {}
+
+    path = sanitize_dir(path)
+
+    footprints = scan_vrt_folder(path, vrts, update_catalog=update_catalog)
+
+    ortho_data_cols = ['fn', 'extent']
+    ortho_data = []
+    ortho_shapes = []
+
+    for f in (tqdm(vrts) if progress else vrts):
+
+        f_ind = f.replace(".vrt", "")
+
+        # Find ortho bounds
+        gt, w, h = footprints[f]
+        extent = extent_from_geotransform(gt, w, h)  # Extent of image
+
+        # Get the mask shape
+        contour = load_mask_contour(os.path.join(path, f_ind + ".mask.png"), want_narrow=want_narrow,
+                                    mask_hash=mask_hashes.get(f_ind))
+        if len(contour) < 3:
+            continue  # Nothing of the mask is left, no defects can fall on this frame
+        maskpoly = contour_to_polygon(contour, gt)
+
+        # Append info
+        ortho_data.append([f_ind, extent])
+        ortho_shapes.append(maskpoly)
+
+    df = pd.DataFrame(data=ortho_data, columns=ortho_data_cols)
+
+    # Once all over, create and return the dataframe
+    return gpd.GeoDataFrame(df, crs={'init': 'espg:3301'}, geometry=ortho_shapes)
+
+
+# Process a folder with VRT files - create a GeoPandas dataframe
+# with relevant information about file and the mask shape
+# Returns a dataframe with this information
+def process_vrt_folder(path, want_narrow=False):
+
+    path = sanitize_dir(path)
+
+    print("Creating shapes for masks...")
+
+    return process_vrt_frames(path, list_vrts(path), want_narrow=want_narrow)
+
+
+# Prefilter the defects with the spatial index (R-tree) of the shapefile: keep only the
+# defects whose bounding boxes hit the bounding box of at least one frame shape.
+# The index is built once per shapefile and reused by every folder.
+# Original row order is preserved
+def prefilter_defects(orthoshapes, shp):
+
+    sindex = shp.sindex
+
+    candidates = set()
+    for geom in orthoshapes.geometry:
+        candidates.update(sindex.intersection(geom.bounds))
+
+    return shp.iloc[sorted(candidates)]
+
+
+# Intersect the frame shapes with the defect shapefile
+def overlay_defects(orthoshapes, shp, prefilter=PREFILTER_DEFECTS):
+
+    # The exact intersection is only computed against the candidates
+    if prefilter:
+        shp = prefilter_defects(orthoshapes, shp)
+
+    # explode() at the end explodes multipolygons to polygons while duplicating entries
+    # replace() replaces Type=None with "määramata"
+    ovrl = gpd.overlay(orthoshapes, shp, how='intersection').explode()
+    ovrl.replace(to_replace=[None], value=lbl_undefined, inplace=True)
+
+    return ovrl
+
+
+# Get list of top level dirs to process, absolute paths with os.sep converted
+# to / since python understands it even in windows
+def get_paths_to_process(base_path, add_file=None):
+    base_path = base_path.replace("\\", "/")
+    base_path = base_path[:-1] if base_path.endswith("/") else base_path  # Typical sanitization
+    dirs = next(os.walk(base_path))[1]
+    return {d: base_path + "/" + d + (("/" + add_file) if add_file else "") for d in dirs}
+
+
+# Join the overlay results and add the origin column derived from the file names.
+# Results without any defects would only disturb the column dtypes of the join, so they are skipped
+def join_overlays(gdf_list):
+
+    nonempty = [gdf for gdf in gdf_list if not gdf.empty]
+    full_defect_db = join_gdf(nonempty if nonempty else gdf_list[:1])
+
+    if "fn" in full_defect_db:
+        full_defect_db["origin"] = [fn.split("-")[0] for fn in full_defect_db["fn"]]
+
+    return full_defect_db
+
+
+# Serial build: process the folders one by one and overlay them with the shapefile(s).
+# shp_files maps folder keys to shapefiles, alternatively a single GeoDataFrame
+# can be given as shp that is then used for all the folders
+def build_defect_db(ortho_dirs, shp_files=None, shp=None, want_narrow=False):
+
+    gdf_list = []
+
+    dir_cnt = 1
+    dir_total = len(ortho_dirs)
+
+    for k in ortho_dirs:
+        print("Processing folder", dir_cnt, "of", dir_total)
+        orthoshapes = process_vrt_folder(ortho_dirs[k], want_narrow=want_narrow)
+        folder_shp = shp if shp is not None else gpd.read_file(shp_files[k])
+        gdf_list.append(overlay_defects(orthoshapes, folder_shp))
+        dir_cnt += 1
+
+    return join_overlays(gdf_list)
+
+
+# %% Parallel build
+
+# Last shapefile read by this worker process. Tasks arrive in folder order and the
+# shared shapefile of the second database is large, so keeping one is enough
+_worker_shp_cache = {}
+
+
+def _get_worker_shp(shp_file):
+    if shp_file not in _worker_shp_cache:
+        _worker_shp_cache.clear()
+        _worker_shp_cache[shp_file] = gpd.read_file(shp_file)
+    return _worker_shp_cache[shp_file]
+
+
+# Worker task: create the frame shapes for a chunk of VRTs and overlay them with the shapefile.
+# The footprint catalogs are written by split_build_tasks in the main process, workers only read them
+def _process_frames_task(path, vrts, shp_file, want_narrow, mask_hashes=None):
+    orthoshapes = process_vrt_frames(path, vrts, want_narrow=want_narrow, progress=False, update_catalog=False,
+                                     mask_hashes=mask_hashes)
+    return overlay_defects(orthoshapes, _get_worker_shp(shp_file))
+
+
+# Split the VRTs of every folder into tasks of at most frames_per_task frames.
+# If frames (folder key -> frame names) is given, only those frames are included.
+# Returns a list of (folder key, path, vrt chunk) in folder/frame order
+def split_build_tasks(ortho_dirs, frames_per_task=FRAMES_PER_TASK, frames=None):
+    tasks = []
+    for k in ortho_dirs:
+        if frames is not None and k not in frames:
+            continue
+        path = sanitize_dir(ortho_dirs[k])
+        if frames is None:
+            vrts = list_vrts(path)
+        else:
+            vrts = [f + ".vrt" for f in frames[k]]
+
+        # Refresh the footprint catalog of the folder before the workers need it
+        scan_vrt_folder(path, vrts)
+        for i in range(0, len(vrts), frames_per_task):
+            tasks.append((k, path, vrts[i:i + frames_per_task]))
+    return tasks
+
+
+# Run the build tasks in a process pool (or in this process if workers == 1).
+# Either shp_files (folder key -> shapefile) or shp_file (one shapefile for all folders)
+# must be given as paths, since the workers read the shapefiles themselves.
+# mask_hashes (folder key -> {frame: mask hash}, from the manifest) is passed on to the tasks.
+# Yields (task index, overlay result) in completion order
+def iter_build_tasks(tasks, shp_files=None, shp_file=None, want_narrow=False, workers=None, mask_hashes=None):
+
+    mask_hashes = mask_hashes if mask_hashes is not None else {}
+    args = [(path, vrts, shp_file if shp_files is None else shp_files[k], want_narrow,
+             {f[:-len(".vrt")]: mask_hashes[k][f[:-len(".vrt")]] for f in vrts} if k in mask_hashes else None)
+            for k, path, vrts in tasks]
+
+    if workers == 1:
+        for i, a in enumerate(tqdm(args)):
+            yield i, _process_frames_task(*a)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_process_frames_task, *a): i for i, a in enumerate(args)}
+        for fut in tqdm(as_completed(futures), total=len(futures)):
+            yield futures[fut], fut.result()
+
+
+# Same as iter_build_tasks, but returns the overlay results in task order
+def run_build_tasks(tasks, shp_files=None, shp_file=None, want_narrow=False, workers=None, mask_hashes=None):
+
+    gdf_list = [None] * len(tasks)
+    for i, gdf in iter_build_tasks(tasks, shp_files=shp_files, shp_file=shp_file,
+                                   want_narrow=want_narrow, workers=workers, mask_hashes=mask_hashes):
+        gdf_list[i] = gdf
+
+    return gdf_list
+
+
+# Parallel build: folders, and frames inside large folders, are processed in a process pool.
+# The chunks are joined back in folder/frame order, so the result is identical to build_defect_db
+def build_defect_db_parallel(ortho_dirs, shp_files=None, shp_file=None, want_narrow=False,
+                             workers=None, frames_per_task=FRAMES_PER_TASK):
+
+    tasks = split_build_tasks(ortho_dirs, frames_per_task)
+
+    print("Processing", len(ortho_dirs), "folders in", len(tasks), "tasks...")
+
+    gdf_list = run_build_tasks(tasks, shp_files=shp_files, shp_file=shp_file,
+                               want_narrow=want_narrow, workers=workers)
+
+    return join_overlays(gdf_list)
+
+
+# Streaming build: every folder is written to a partition of the writer (PartitionedDbWriter)
+# as soon as all of its chunks are done, so the results are not kept in memory until the end.
+# manifests (folder key -> manifest of its inputs) are stored with the partitions; which folders
+# need to be built is decided by the caller (see defect_db_manifest.update_partitioned_db)
+def build_defect_db_partitioned(ortho_dirs, writer, shp_files=None, shp_file=None, want_narrow=False,
+                                workers=None, frames_per_task=FRAMES_PER_TASK, manifests=None, mask_hashes=None):
+
+    manifests = manifests if manifests is not None else {}
+
+    tasks = split_build_tasks(ortho_dirs, frames_per_task)
+
+    # Chunks still missing for every folder
+    pending = {}
+    for k, _, _ in tasks:
+        pending[k] = pending.get(k, 0) + 1
+
+    # Folders without any frames are complete right away
+    for k in ortho_dirs:
+        if k not in pending:
+            writer.write(k, join_overlays([]), manifests.get(k))
+
+    results = {}
+    for i, gdf in iter_build_tasks(tasks, shp_files=shp_files, shp_file=shp_file,
+                                   want_narrow=want_narrow, workers=workers, mask_hashes=mask_hashes):
+        k = tasks[i][0]
+        results.setdefault(k, {})[i] = gdf
+        pending[k] -= 1
+
+        # Folder done: join its chunks in frame order and write the partition
+        if pending[k] == 0:
+            chunks = results.pop(k)
+            writer.write(k, join_overlays([chunks[j] for j in sorted(chunks)]), manifests.get(k))
@@ -0,0 +1,211 @@
+## Manifest of the input files of the defect database
+#  For every input file (VRT, mask, shapefile) we store its size, mtime and content hash.
+#  Comparing a fresh scan against the manifest stored with the database tells which
+#  folders and frames need to be reprocessed
+
+import os
+import glob
+import pickle
+
+from defect_db_build import POLY_APPROX_TOLERANCE, NARROW_MASK_MODE, contour_params, \
+    list_vrts, sanitize_dir, split_build_tasks, run_build_tasks, join_overlays, build_defect_db_partitioned
+from lib.polygon_cache import hash_file  # lib is on the path via defect_db_build
+
+# Mask file naming
+MASK_EXT = ".mask.png"
+
+# Manifest file is stored next to the database file
+MANIFEST_EXT = ".manifest.pkl"
+
+# Manifest entry of a single file: (size, mtime, hash). If the size and mtime match
+# the old entry, the file is not read again and the old hash is reused
+def file_entry(fn, old_entry=None):
+    st = os.stat(fn)
+    if old_entry is not None and old_entry[0] == st.st_size and old_entry[1] == st.st_mtime:
+        return old_entry
+    return st.st_size, st.st_mtime, hash_file(fn)
+
+
+# A shapefile consists of several files (attributes live in the .dbf), all of them are tracked
+def shapefile_entry(shp_file, old_entry=None):
+    old_entry = old_entry if old_entry is not None else {}
+    base = os.path.splitext(shp_file)[0]
+    return {fn: file_entry(fn, old_entry.get(fn)) for fn in sorted(glob.glob(base + ".*"))}
+
+
+# Scan the input files. Returns the manifest:
+# {"params": build parameters,
+#  "shapefiles": {folder key or "*" for the shared one: shapefile entry},
+#  "frames": {folder key: {frame: (vrt entry, mask entry)}}}
+def scan_inputs(ortho_dirs, shp_files=None, shp_file=None, params=None, old_manifest=None):
+
+    old_manifest = old_manifest if old_manifest is not None else {"shapefiles": {}, "frames": {}}
+
+    manifest = {"params": params, "shapefiles": {}, "frames": {}}
+
+    # Shapefiles
+    shps = {"*": shp_file} if shp_files is None else shp_files
+    for k, fn in shps.items():
+        manifest["shapefiles"][k] = shapefile_entry(fn, old_manifest["shapefiles"].get(k))
+
+    # Frames
+    for k in ortho_dirs:
+        path = sanitize_dir(ortho_dirs[k])
+        old_frames = old_manifest["frames"].get(k, {})
+        frames = {}
+        for f in list_vrts(path):
+            f_ind = f.replace(".vrt", "")
+            old_vrt, old_mask = old_frames.get(f_ind, (None, None))
+            frames[f_ind] = (file_entry(path + f, old_vrt),
+                             file_entry(path + f_ind + MASK_EXT, old_mask))
+        manifest["frames"][k] = frames
+
+    return manifest
+
+
+# Content hashes of the masks (folder key -> {frame: hash}), handed to the build so that
+# the mask polygon cache does not hash the masks again
+def mask_hashes(manifest):
+    return {k: {f: e[1][2] for f, e in frames.items()} for k, frames in manifest["frames"].items()}
+
+
+# Only the content hashes decide whether a file changed: a file that was merely touched
+# gets a new mtime in the manifest, but is not reprocessed
+def _frame_hashes(frame_entry):
+    return None if frame_entry is None else tuple(e[2] for e in frame_entry)
+
+
+def _shapefile_hashes(shp_entry):
+    return None if shp_entry is None else {fn: e[2] for fn, e in shp_entry.items()}
+
+
+# Build parameters stored in the manifest: a change in any of them rebuilds everything
+def build_params(want_narrow):
+    return {"want_narrow": want_narrow, "tolerance": POLY_APPROX_TOLERANCE,
+            "contour_backend": contour_params(want_narrow), "narrow_mode": NARROW_MASK_MODE}
+
+
+# Compare two manifests. Returns (rebuild_all, changed, removed) where
+# changed maps folder keys to the frames that must be (re)processed and
+# removed is the set of frames whose rows must be dropped from the database
+def diff_manifests(old_manifest, manifest):
+
+    # Different build parameters or a changed shared shapefile affect every frame
+    if old_manifest is None or old_manifest["params"] != manifest["params"] \
+            or _shapefile_hashes(old_manifest["shapefiles"].get("*")) \
+            != _shapefile_hashes(manifest["shapefiles"].get("*")):
+        return True, None, None
+
+    changed = {}
+    removed = set()
+
+    for k, frames in manifest["frames"].items():
+        old_frames = old_manifest["frames"].get(k, {})
+
+        # With a changed folder shapefile all the frames of that folder are redone
+        if _shapefile_hashes(old_manifest["shapefiles"].get(k)) != _shapefile_hashes(manifest["shapefiles"].get(k)):
+            changed_frames = list(frames)
+        else:
+            changed_frames = [f for f in frames if _frame_hashes(old_frames.get(f)) != _frame_hashes(frames[f])]
+
+        if changed_frames:
+            changed[k] = changed_frames
+
+        # Rows of changed frames are replaced, so those are removed as well
+        removed.update(changed_frames)
+        removed.update(f for f in old_frames if f not in frames)
+
+    # Whole folders that have disappeared
+    for k, old_frames in old_manifest["frames"].items():
+        if k not in manifest["frames"]:
+            removed.update(old_frames)
+
+    return False, changed, removed
+
+
+def manifest_file(db_file):
+    return os.path.splitext(db_file)[0] + MANIFEST_EXT
+
+
+def load_manifest(db_file):
+    fn = manifest_file(db_file)
+    if not os.path.isfile(fn):
+        return None
+    with open(fn, "rb") as f:
+        return pickle.load(f)
+
+
+def save_manifest(db_file, manifest):
+    with open(manifest_file(db_file), "wb") as f:
+        pickle.dump(manifest, f)
+
+
+# Incremental build: scan the inputs, reprocess only the frames that changed since
+# old_manifest was written and splice them into the existing database db.
+# If there is no database or manifest to start from, everything is built.
+# Returns (database, manifest)
+def update_defect_db(db, old_manifest, ortho_dirs, shp_files=None, shp_file=None, want_narrow=False,
+                     workers=None):
+
+    print("Scanning input files...")
+
+    manifest = scan_inputs(ortho_dirs, shp_files=shp_files, shp_file=shp_file, params=build_params(want_narrow),
+                           old_manifest=old_manifest)
+
+    rebuild_all, changed, removed = diff_manifests(old_manifest if db is not None else None, manifest)
+
+    if rebuild_all:
+        print("Building the whole database...")
+        gdf_list = run_build_tasks(split_build_tasks(ortho_dirs), shp_files=shp_files, shp_file=shp_file,
+                                   want_narrow=want_narrow, workers=workers, mask_hashes=mask_hashes(manifest))
+        return join_overlays(gdf_list), manifest
+
+    print("Frames to reprocess:", sum(len(v) for v in changed.values()),
+          "- frames to remove:", len(removed - set(f for v in changed.values() for f in v)))
+
+    gdf_list = []
+    if changed:
+        gdf_list = run_build_tasks(split_build_tasks(ortho_dirs, frames=changed), shp_files=shp_files,
+                                   shp_file=shp_file, want_narrow=want_narrow, workers=workers,
+                                   mask_hashes=mask_hashes(manifest))
+
+    # Drop the rows of the changed and removed frames, then splice in the new ones
+    kept = db[~db["fn"].isin(removed)]
+
+    return join_overlays([kept] + gdf_list), manifest
+
+
+# Partitioned build (see defect_db_build.build_defect_db_partitioned) that reuses the partitions
+# of writer whose inputs have not changed: every partition is stored with the manifest of its
+# folder, and a folder is rebuilt unless that manifest matches a fresh scan of its inputs
+def update_partitioned_db(writer, ortho_dirs, shp_files=None, shp_file=None, want_narrow=False, workers=None):
+
+    print("Scanning input files...")
+
+    params = build_params(want_narrow)
+    old_manifests = {k: writer.read_manifest(k) for k in ortho_dirs}
+
+    # The shared shapefile is hashed once here, the scans of the folders reuse its entry
+    shared_shp = None
+    if shp_files is None:
+        old_shared = next((m["shapefiles"].get("*") for m in old_manifests.values() if m is not None), None)
+        shared_shp = shapefile_entry(shp_file, old_shared)
+
+    manifests = {}
+    todo = {}
+    for k in ortho_dirs:
+        old_manifest = old_manifests[k]
+        known = old_manifest if old_manifest is not None else {"shapefiles": {}, "frames": {}}
+        if shared_shp is not None:
+            known = {"shapefiles": dict(known["shapefiles"], **{"*": shared_shp}), "frames": known["frames"]}
+        manifests[k] = scan_inputs({k: ortho_dirs[k]}, shp_files={k: shp_files[k]} if shp_files is not None else None,
+                                   shp_file=shp_file, params=params, old_manifest=known)
+        rebuild_all, changed, removed = diff_manifests(old_manifest, manifests[k])
+        if rebuild_all or changed or removed:
+            todo[k] = ortho_dirs[k]
+
+    print("Folders up to date:", len(ortho_dirs) - len(todo), "of", len(ortho_dirs))
+
+    build_defect_db_partitioned(todo, writer, shp_files=shp_files, shp_file=shp_file, want_narrow=want_narrow,
+                                workers=workers, manifests=manifests,
+                                mask_hashes={k: mask_hashes(manifests[k])[k] for k in todo})
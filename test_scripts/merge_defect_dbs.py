@@ -0,0 +1,39 @@
+## Merge the defect databases built by create_defect_db_v4.py into one
+#  The inputs can be pickles, partitioned databases (<db name>_parts) or columnar databases.
+#  The result is a partitioned database (one file per origin), written one origin at a time;
+#  identical rows found in several inputs are kept only once.
+#  The defect IDs of the inputs are dropped by the merge; with CLUSTER_DUPLICATES the merged
+#  database is clustered again (this needs the whole database in memory, like the builder)
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.db_merge import merge_defect_dbs
+from lib.db_partitions import PartitionedDbWriter, read_partitioned_db
+from lib.defect_clusters import add_defect_ids, DEFAULT_MIN_OVERLAP
+from lib.process_db import printt, CATEGORICAL_COLS
+
+DB_FILES = [r"C:\Data\_ReachU-defectTypes\201904_Origs\defect_db_v4.pkl",
+            r"C:\Data\_ReachU-defectTypes\__new_2020_06\origin_folders\NEWdefect_db_v4.pkl"]
+
+MERGED_DB_DIR = r"C:\Data\_ReachU-defectTypes\merged_defect_db_v4_parts"
+
+# Assign the defect IDs of the merged database (see create_defect_db_v4.py)
+CLUSTER_DUPLICATES = True
+CLUSTER_MIN_OVERLAP = DEFAULT_MIN_OVERLAP
+
+n_rows, n_dups = merge_defect_dbs(DB_FILES, MERGED_DB_DIR)
+printt("Merged:", n_rows, "rows,", n_dups, "duplicates dropped.")
+
+if CLUSTER_DUPLICATES:
+    printt("Clustering duplicate defects...")
+    merged = add_defect_ids(read_partitioned_db(MERGED_DB_DIR, compact=True), min_overlap=CLUSTER_MIN_OVERLAP)
+    writer = PartitionedDbWriter(MERGED_DB_DIR)
+    for origin, part in merged.groupby(merged["origin"].astype(str)):
+        part = part.reset_index(drop=True)
+        for c in CATEGORICAL_COLS:
+            part[c] = part[c].cat.remove_unused_categories()
+        writer.write(origin, part)
+
+printt("Done.")